@@ -0,0 +1,333 @@
+"""Mide el rendimiento de los barridos contra instrumentos simulados
+
+Corre los lazos reales de vi.py, VI_GUI.medir, cv.py, CV_GUI.medir, cf.py y
+CV_Pulsada.pulso contra las sesiones de simulated.py e informa, para cada
+barrido, puntos por segundo, transacciones de bus por punto y el tiempo total
+dividido en espera (sleep), entrada/salida con los instrumentos, escritura a
+disco y el resto del tiempo de la computadora (formateo, parseo, Python).
+
+    python benchmark.py vi cv --latencia 5ms --json resultados.json
+"""
+import argparse
+import asyncio
+import builtins
+import io
+import json
+import os
+import runpy
+import sys
+import tempfile
+import time
+
+import numpy as np
+from lantz import Q_
+
+import simulated
+from util import logspace
+
+_sleep = time.sleep
+_asyncio_sleep = asyncio.sleep
+_open = builtins.open
+
+
+class Phases(object):
+    """Acumula el tiempo de espera y de disco mientras está instalado"""
+
+    def __init__(self):
+        self.settle = 0.
+        self.disk = 0.
+
+    def install(self):
+        global _current
+        _install_wrappers()
+        _current = self
+
+    def uninstall(self):
+        global _current
+        if _current is self:
+            _current = None
+
+
+# Phases que acumula los tiempos. Los reemplazos de sleep y open se instalan
+# una sola vez, porque los drivers se quedan con el sleep que había al
+# importarlos (from time import sleep)
+_current = None
+
+
+def _timed_sleep(seconds):
+    phases = _current
+    start = time.time()
+    _sleep(seconds)
+    if phases is not None:
+        phases.settle += time.time() - start
+
+
+@asyncio.coroutine
+def _timed_asyncio_sleep(delay, result=None, **kwargs):
+    phases = _current
+    start = time.time()
+    ret = yield from _asyncio_sleep(delay, result, **kwargs)
+    if phases is not None:
+        phases.settle += time.time() - start
+    return ret
+
+
+def _timed_open(file, mode='r', *args, **kwargs):
+    phases = _current
+    if phases is None:
+        return _open(file, mode, *args, **kwargs)
+    start = time.time()
+    fd = _open(file, mode, *args, **kwargs)
+    phases.disk += time.time() - start
+    if any(flag in mode for flag in 'wax+'):
+        return _TimedFile(fd, phases)
+    return fd
+
+
+def _install_wrappers():
+    time.sleep = _timed_sleep
+    asyncio.sleep = _timed_asyncio_sleep
+    builtins.open = io.open = _timed_open
+
+
+class _TimedFile(object):
+    def __init__(self, fd, phases):
+        self._fd = fd
+        self._phases = phases
+
+    def _timed(self, method, *args):
+        start = time.time()
+        try:
+            return getattr(self._fd, method)(*args)
+        finally:
+            self._phases.disk += time.time() - start
+
+    def write(self, data):
+        return self._timed('write', data)
+
+    def writelines(self, lines):
+        return self._timed('writelines', lines)
+
+    def flush(self):
+        return self._timed('flush')
+
+    def close(self):
+        return self._timed('close')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._fd)
+
+    def __getattr__(self, name):
+        return getattr(self._fd, name)
+
+
+class _Widget(object):
+    """Reemplazo de los controles de la interfaz: devuelve valores fijos"""
+
+    def __init__(self, value=''):
+        self.value = value
+
+    def text(self):
+        return self.value
+
+    def isChecked(self):
+        return bool(self.value)
+
+    def setText(self, text):
+        self.value = text
+
+    def __call__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        # set_xdata, canvas.draw, setMidiendo, etc. no hacen nada
+        return _Widget()
+
+
+class _Form(object):
+    def __init__(self, **widgets):
+        for name, value in widgets.items():
+            setattr(self, name, _Widget(value))
+
+    def __getattr__(self, name):
+        return _Widget()
+
+
+def run_script(script, argv):
+    old_argv = sys.argv
+    sys.argv = [script] + argv
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), script), run_name='__main__')
+    finally:
+        sys.argv = old_argv
+
+
+def run_coroutine(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def vi_script(options, *extra):
+    """Barrido de corriente de vi.py"""
+    imin, imax = Q_(1, 'nA'), Q_(1, 'mA')
+    run_script('vi.py', ['salida.txt', '--imin', str(imin), '--imax',
+                         str(imax), '--puntosdecada', str(options.puntos),
+                         '--vlimite', '10V'] + list(extra))
+    return len(logspace(imin, imax, options.puntos))
+
+
+def vi_gui(options):
+    """Barrido de corriente de VI_GUI.medir"""
+    from keithley220 import Keithley220
+    from keithley617 import Keithley617
+    from keithley705 import Keithley705
+    from vi_gui import VI_GUI
+    self = _Form()
+    self.ui = _Form(limite_tension='10V', estres='0s')
+    self.i_src = Keithley220('GPIB0::12::INSTR')
+    self.electrometro = Keithley617('GPIB0::28::INSTR')
+    self.matriz = Keithley705('GPIB0::29::INSTR')
+    for inst in (self.i_src, self.electrometro, self.matriz):
+        inst.initialize()
+    self.corrientes = logspace(Q_(1, 'nA'), Q_(1, 'mA'), options.puntos)
+    self.tensiones = Q_(np.empty(len(self.corrientes)), 'V')
+    run_coroutine(VI_GUI.medir(self))
+    run_coroutine(VI_GUI.terminar(self))
+    return len(self.corrientes)
+
+
+def cv_script(options):
+    """Barrido de bias de cv.py"""
+    run_script('cv.py', ['salida.txt', '--vinicial', '-3V', '--vfinal', '3V',
+                         '--pasos', str(options.puntos)])
+    return options.puntos
+
+
+def cv_gui(options, lcr='hp'):
+    """Barrido de bias de CV_GUI.medir"""
+    from keithley705 import Keithley705
+    from gwinsteklcr8110g import GwinstekLCR8110G
+    from hp4277a import HP4277A
+    import cv_gui
+    cv_gui.get_save_filename = lambda *args, **kwargs: 'salida.txt'
+    self = _Form()
+    self.npromedios = cv_gui.CV_GUI.npromedios
+    self.ui = _Form(frecuencia='100kHz', inicial='-3V', ffinal='3V',
+                    puntos=str(options.puntos), pausa='10ms')
+    self.matriz = Keithley705('GPIB0::29::INSTR')
+    self.gwinstek = GwinstekLCR8110G(port=0, timeout=5)
+    self.hp = HP4277A('GPIB0::17::INSTR')
+    for inst in (self.matriz, self.gwinstek, self.hp):
+        inst.initialize()
+    self.lcr = getattr(self, lcr)
+    run_coroutine(cv_gui.CV_GUI.medir(self))
+    run_coroutine(cv_gui.CV_GUI.terminar(self))
+    return options.puntos
+
+
+def cf_script(options):
+    """Barrido de frecuencia de cf.py"""
+    run_script('cf.py', [])
+    return 10
+
+
+def cv_pulsada(options):
+    """Pulsos de CV_Pulsada.pulso"""
+    from hp8112a import HP8112A
+    from gwinstekgds2062 import GwinstekGDS2062
+    from cv_pulsada import CV_Pulsada
+    gen = HP8112A('GPIB0::11::INSTR')
+    osc = GwinstekGDS2062('ASRL5::INSTR')
+    gen.initialize()
+    osc.initialize()
+    cv = CV_Pulsada(gen, osc)
+    run_coroutine(cv.configurar())
+    gen.enable = True
+    anchos = logspace(Q_(100, 'us'), Q_(100, 'ms'), options.puntos)
+    for ii, ancho in enumerate(anchos):
+        run_coroutine(cv.setAncho(ancho, True, ii % 2 == 0))
+        run_coroutine(cv.pulso())
+    return len(anchos)
+
+
+scenarios = dict(vi=(vi_script, simulated.iv_bench),
+                 vi_secuencia=(lambda options: vi_script(
+                     options, '--secuencia', 'bus'), simulated.iv_bench),
+                 vi_gui=(vi_gui, simulated.iv_bench),
+                 cv=(cv_script, simulated.cv_bench),
+                 cv_gui=(cv_gui, simulated.cv_bench),
+                 cv_gui_gwinstek=(lambda options: cv_gui(options, 'gwinstek'),
+                                  simulated.cv_bench),
+                 cf=(cf_script, simulated.cv_bench),
+                 cv_pulsada=(cv_pulsada, simulated.pulse_bench))
+
+
+def run(name, options):
+    """Corre un escenario y devuelve sus métricas"""
+    scenario, bench = scenarios[name]
+    sessions = bench(default_latency=options.latencia.to('s').magnitude)
+    simulated.install(sessions)
+    phases = Phases()
+    old_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        phases.install()
+        start = time.time()
+        try:
+            points = scenario(options)
+        finally:
+            total = time.time() - start
+            phases.uninstall()
+            simulated.uninstall()
+            os.chdir(old_dir)
+    transactions = sum(session.transactions for session in sessions.values())
+    io_time = sum(session.io_time for session in sessions.values())
+    return dict(escenario=name, puntos=points,
+                puntos_por_segundo=points / total,
+                transacciones_por_punto=transactions / points,
+                total=total, espera=phases.settle, io=io_time,
+                disco=phases.disk,
+                parseo=total - phases.settle - io_time - phases.disk)
+
+
+columns = [('Escenario', 'escenario', '<16', ''),
+           ('Puntos', 'puntos', '>7', 'd'),
+           ('Puntos/s', 'puntos_por_segundo', '>9', '.2f'),
+           ('Trans/pt', 'transacciones_por_punto', '>9', '.1f'),
+           ('Total[s]', 'total', '>9', '.2f'),
+           ('Espera', 'espera', '>8', '.2f'),
+           ('E/S', 'io', '>8', '.2f'),
+           ('Parseo', 'parseo', '>8', '.2f'),
+           ('Disco', 'disco', '>8', '.2f')]
+
+def report(results):
+    print(' '.join('{:{}}'.format(header, width)
+                   for header, key, width, fmt in columns))
+    for result in results:
+        print(' '.join('{:{}{}}'.format(result[key], width, fmt)
+                       for header, key, width, fmt in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('escenarios', nargs='*', default=sorted(scenarios),
+                        choices=sorted(scenarios), metavar='escenario',
+                        help='Barridos a medir: ' + ', '.join(sorted(
+                            scenarios)))
+    parser.add_argument('--puntos', type=int, default=5,
+                        help='Puntos por década o cantidad de pasos')
+    parser.add_argument('--latencia', type=Q_, default=Q_(2, 'ms'),
+                        help='Latencia de cada comando de bus')
+    parser.add_argument('--json', help='Guardar resultados en este archivo')
+    args = parser.parse_args()
+    results = [run(name, args) for name in args.escenarios]
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
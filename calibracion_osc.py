@@ -0,0 +1,176 @@
+"""Calibra las esperas de la captura de disparo único del osciloscopio
+
+Para cada largo de registro y escala de tiempo tira pulsos con el generador
+variando la espera entre RUN y el disparo, y mide la fracción de capturas
+exitosas y cuánto tarda el osciloscopio en completarlas. Guarda, para cada
+combinación, la menor espera segura y la mayor demora de captura en un
+archivo JSON que CV_Pulsada lee en vez de usar márgenes fijos.
+
+    python calibracion_osc.py calibracion_osc.json --escalas 1us 100us 10ms
+
+Reemplaza a osc_time.py, osc_time_p.py y osc_time_p2.py.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from lantz import Q_
+
+logger = logging.getLogger(__name__)
+
+
+def clave(record_length, time_scale):
+    return '{}:{:.3e}'.format(record_length, Q_(time_scale).to('s').magnitude)
+
+
+class TablaTiempos(object):
+    """Esperas medidas por calibracion_osc.py
+
+    armado es la espera entre RUN y el disparo con delay nulo, captura lo
+    que tarda el osciloscopio en completar la adquisición desde el disparo,
+    ambos en segundos. Devuelven None para combinaciones no calibradas."""
+
+    def __init__(self, archivo=None):
+        self.tabla = dict()
+        if archivo is not None and os.path.exists(archivo):
+            with open(archivo) as fd:
+                self.tabla = json.load(fd)
+
+    def agregar(self, record_length, time_scale, **valores):
+        self.tabla[clave(record_length, time_scale)] = valores
+
+    def buscar(self, record_length, time_scale, campo):
+        return self.tabla.get(clave(record_length, time_scale), {}).get(campo)
+
+    def armado(self, record_length, time_scale):
+        return self.buscar(record_length, time_scale, 'armado')
+
+    def captura(self, record_length, time_scale):
+        return self.buscar(record_length, time_scale, 'captura')
+
+    def guardar(self, archivo):
+        with open(archivo, 'w') as fd:
+            json.dump(self.tabla, fd, indent=2, sort_keys=True)
+
+
+def medir(gen, osc, pausa, pruebas, timeout):
+    """Fracción de capturas exitosas y sus demoras desde el disparo"""
+    from gwinstekgds2062 import AcquisitionError
+    exitos = 0
+    demoras = []
+    for ii in range(pruebas):
+        osc.run()
+        time.sleep(pausa)
+        inicio = time.time()
+        gen.trigger()
+        if not osc.wait_acquisition(timeout):
+            continue
+        demora = time.time() - inicio
+        try:
+            osc.acquire([1], lazy=True)
+        except AcquisitionError:
+            continue
+        exitos += 1
+        demoras.append(demora)
+    return exitos / pruebas, demoras
+
+
+def calibrar(gen, osc, largos, escalas, margenes, pruebas, exito,
+             tabla=None):
+    """Agrega a tabla las esperas de cada largo de registro y escala"""
+    if tabla is None:
+        tabla = TablaTiempos()
+    for largo in largos:
+        for escala in escalas:
+            # Sin RUN cambia el zoom en vez de la escala de adquisición
+            osc.run()
+            osc.update(record_length=largo, time_scale=escala)
+            ventana = osc.xdivisions * escala.to('s').magnitude
+            # Hay que llenar la parte previa al disparo, media ventana
+            pausas = .5 * ventana + np.sort(margenes)
+            timeout = 2. * ventana + 1.
+            resultados = []
+            print('Largo {}, escala {:~}'.format(largo, escala))
+            print('Espera[s]\tÉxito\tCaptura[s]')
+            for pausa in pausas:
+                fraccion, demoras = medir(gen, osc, pausa, pruebas, timeout)
+                demora = max(demoras) if demoras else None
+                resultados.append((pausa, fraccion, demora))
+                print('{:.4f}\t{:.2f}\t{}'.format(pausa, fraccion, demora))
+            # La menor espera a partir de la cual todas tienen éxito
+            seguras = []
+            for pausa, fraccion, demora in reversed(resultados):
+                if fraccion < exito:
+                    break
+                seguras.insert(0, (pausa, demora))
+            if not seguras:
+                logger.warning('Ninguna espera segura para largo %s, '
+                               'escala %s', largo, escala)
+                continue
+            armado = seguras[0][0]
+            captura = max((demora for pausa, demora in seguras
+                           if demora is not None), default=None)
+            tabla.agregar(largo, escala, armado=armado, captura=captura,
+                          resultados=resultados)
+    return tabla
+
+
+def configurar(gen, osc, tension):
+    """Pulsos cortos disparados por bus, capturados en el canal 1"""
+    gen.update(trigger_mode = 'trigger', width = Q_(200, 'ns'),
+        leading_edge = Q_(50, 'ns'), trailing_edge = Q_(50, 'ns'),
+        high_level = tension, low_level = -tension, enable = True)
+    # Sin RUN el delay y la escala de tiempo sólo cambian el zoom
+    osc.run()
+    osc.update(mode = 'normal', display = {1: True, 2: False},
+        offset = {1: Q_(0, 'V')}, voltage_scale = {1: osc.fit_voltage(
+            2 * tension)},
+        trigger_level = Q_(0, 'V'), trigger_mode = 'single',
+        trigger_slope = 'rising', trigger_source = 1, trigger_type = 'edge',
+        delay = Q_(0, 's'))
+
+
+if __name__ == '__main__':
+    import argparse
+    import lantz
+    from hp8112a import HP8112A
+    from gwinstekgds2062 import GwinstekGDS2062
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('archivo', help='Tabla de tiempos (JSON); si existe '
+                        'se agregan las combinaciones medidas')
+    parser.add_argument('--escalas', type=Q_, nargs='+',
+                        default=[Q_(1, 'us'), Q_(100, 'us'), Q_(10, 'ms')],
+                        help='Escalas de tiempo a calibrar')
+    parser.add_argument('--largos', type=int, nargs='+', default=[0, 1],
+                        help='Largos de registro a calibrar (0 o 1)')
+    parser.add_argument('--margenes', type=Q_, nargs='+',
+                        default=[Q_(ms, 'ms') for ms in
+                                 (0, 2, 5, 10, 20, 50, 100, 200)],
+                        help='Esperas a probar además de media ventana')
+    parser.add_argument('--pruebas', type=int, default=20,
+                        help='Pulsos por espera')
+    parser.add_argument('--exito', type=float, default=1.,
+                        help='Fracción de capturas exitosas para considerar '
+                        'segura una espera')
+    parser.add_argument('--tension', type=Q_, default=Q_(2, 'V'),
+                        help='Amplitud de los pulsos')
+    args = parser.parse_args()
+
+    consola = logging.StreamHandler()
+    consola.setLevel(logging.DEBUG)
+    logger.addHandler(consola)
+
+    gen = HP8112A('GPIB0::11::INSTR')
+    osc = GwinstekGDS2062('ASRL5::INSTR')
+    lantz.initialize_many([gen, osc])
+    configurar(gen, osc, args.tension.to('V'))
+    margenes = np.array([margen.to('s').magnitude
+                         for margen in args.margenes])
+    tabla = calibrar(gen, osc, args.largos,
+                     [escala.to('s') for escala in args.escalas], margenes,
+                     args.pruebas, args.exito, TablaTiempos(args.archivo))
+    tabla.guardar(args.archivo)
+    gen.enable = False
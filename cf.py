@@ -13,11 +13,14 @@ puntos_por_decada = 5
 frecuencias = np.power(10, np.arange(4, 6, 1./puntos_por_decada))
 print('#F [Hz]\tC[F]\tR[Ohm]')
 for frecuencia in frecuencias:
-    lcr.frequency(Q_(frecuencia, 'Hz'))
+    lcr.frequency = Q_(frecuencia, 'Hz')
     try:
         c, r = lcr.measure_stable()
     except:
         continue
+    if not lcr.last_convergence.converged:
+        # Salteo las frecuencias en las que la medición no se estabilizó
+        continue
     print('{}\t{}\t{}'.format(frecuencia, c, r))
 
 lcr.finalize()
@@ -55,8 +55,7 @@ class Contacto(base):
     def on_activar_toggled(self, state):
         if state:
             self.timer.start()
-            for canal in [(3, 2), (3, 3), (3, 4), (5, 1)]:
-                self.matriz.close(canal)
+            self.matriz.apply_routing('cv')
         else:
             self.timer.stop()
             self.matriz.reset()
@@ -0,0 +1,105 @@
+"""Repeat a reading until it settles
+
+    conv = Convergence(window=3, rtol=1e-3, max_reads=50)
+    result = conv.run(lambda: inst.voltage.to('V').magnitude)
+    if not result.converged:
+        print('Did not settle after {} reads'.format(result.reads))
+
+Readings can be numbers or tuples of numbers (C and R from an LCR meter).
+"""
+import asyncio
+from collections import deque, namedtuple
+from time import time
+
+import numpy as np
+
+
+class ConvergenceResult(namedtuple('ConvergenceResult',
+                                   'value reads spread elapsed converged')):
+    """value is the mean of the last window readings, spread their max - min,
+    elapsed the seconds since the first read"""
+
+
+class Convergence(object):
+    """Rolling window convergence detector
+
+    The readings converged when, for every checked component, the spread of
+    the last `window` readings is within atol + rtol * |mean|. Gives up after
+    max_reads readings or timeout seconds (None for no limit).
+
+    components selects which elements of tuple readings are checked (all by
+    default)."""
+
+    def __init__(self, window=2, rtol=1e-2, atol=0., max_reads=100,
+                 timeout=None, components=None):
+        if window < 2:
+            raise ValueError('Need at least two readings to compare')
+        self.window = window
+        self.rtol = rtol
+        self.atol = atol
+        self.max_reads = max_reads
+        self.timeout = timeout
+        self.components = components
+        self.start()
+
+    def start(self):
+        """Forget previous readings"""
+        self.readings = deque(maxlen=self.window)
+        self.reads = 0
+        self.started = time()
+        self.scalar = True
+
+    def add(self, reading):
+        """Add a reading, return whether the window converged"""
+        self.scalar = np.ndim(reading) == 0
+        self.readings.append(np.atleast_1d(np.asarray(reading, dtype=float)))
+        self.reads += 1
+        return self.converged()
+
+    def statistics(self):
+        """Mean and spread of the readings in the window"""
+        data = np.array(self.readings)
+        return data.mean(axis=0), data.max(axis=0) - data.min(axis=0)
+
+    def converged(self):
+        if len(self.readings) < self.window:
+            return False
+        mean, spread = self.statistics()
+        if self.components is not None:
+            mean, spread = mean[self.components], spread[self.components]
+        return bool(np.all(spread <= self.atol + self.rtol * np.abs(mean)))
+
+    def exhausted(self):
+        """True when the read count or time limit was reached"""
+        return ((self.max_reads is not None and self.reads >= self.max_reads)
+                or (self.timeout is not None and
+                    time() - self.started >= self.timeout))
+
+    def result(self, converged):
+        mean, spread = self.statistics()
+        if self.scalar:
+            mean, spread = mean[0], spread[0]
+        else:
+            mean, spread = tuple(mean), tuple(spread)
+        return ConvergenceResult(mean, self.reads, spread,
+                                 time() - self.started, converged)
+
+    def run(self, read):
+        """Call read() until convergence or a limit"""
+        self.start()
+        while True:
+            if self.add(read()):
+                return self.result(True)
+            if self.exhausted():
+                return self.result(False)
+
+    @asyncio.coroutine
+    def run_async(self, read):
+        """Like run, with read a coroutine function"""
+        self.start()
+        while True:
+            reading = yield from read()
+            if self.add(reading):
+                return self.result(True)
+            if self.exhausted():
+                return self.result(False)
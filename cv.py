@@ -43,13 +43,7 @@ bias_source.initialize()
 # Configuro la matriz
 matriz.matrix_mode()
 matriz.reset()
-conexiones = [(3, 2),
-              (3, 3),
-              (3, 4),
-              (5, 1)]
-for canal in conexiones:
-    matriz.close(canal)
-matriz.execute()
+matriz.apply_routing('cv')
 
 # Configuro el LCR
 lcr.equivalent_circuit = 'parallel'
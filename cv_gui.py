@@ -1,5 +1,6 @@
 import logging
 import asyncio
+import sys
 import taskwrap
 import numpy as np
 
@@ -11,6 +12,7 @@ from lantzinitializedialog import LantzInitializeDialog
 from savesettings import SaveSettings
 from autoincrement_file import get_save_filename
 from util import arange, linspace
+from precision import PrecisionAverager
 
 from lantz import Q_
 from keithley705 import Keithley705
@@ -23,6 +25,11 @@ form, base = loadUiType('cv.ui')
 
 class CV_GUI(base):
     npromedios = 5
+    # Precisión relativa de C en cada punto; con None se promedian siempre
+    # npromedios lecturas (sólo el HP) a la velocidad configurada
+    precision = None
+    # Velocidad del LCR antes de calibrar, se restaura al terminar
+    velocidad = None
     def __init__(self, parent=None):
         super().__init__(parent)
         self.ui = form()
@@ -100,8 +107,7 @@ class CV_GUI(base):
                 filter='*.txt;;*.*')
         if filename == '':
             return
-        for canal in [(3, 2), (3, 3), (3, 4), (5, 1)]:
-            yield from self.matriz.close_async(canal)
+        yield from self.matriz.apply_routing_async('cv')
         yield from self.lcr.update_async(equivalent_circuit = 'parallel',
                 frequency = Q_(self.ui.frecuencia.text()).to('Hz'))
 
@@ -122,6 +128,13 @@ class CV_GUI(base):
             tensiones = Q_(np.concatenate((tensiones, tensiones[::-1])), 'V')
         yield from self.hp.update_async(bias_voltage = tensiones[0])
         yield from asyncio.sleep(1)
+        if self.precision is not None:
+            promediador = PrecisionAverager(self.lcr, self.precision,
+                                            self.npromedios)
+            self.velocidad = yield from self.lcr.refresh_async('speed')
+            self.ui.estado.setText("Calibrando velocidades...")
+            perfiles = yield from promediador.calibrate_async(self.leer)
+            logger.debug("Velocidades: {}".format(perfiles))
         cv = np.zeros((len(tensiones), 2))
         for ii, tension in enumerate(tensiones):
             self.ui.estado.setText("{}/{}".format(ii+1, len(tensiones)))
@@ -131,16 +144,23 @@ class CV_GUI(base):
             yield from asyncio.sleep(Q_(self.ui.pausa.text()
                 ).to('s').magnitude)
             logger.debug("Medir...")
-            if self.lcr is self.gwinstek:
+            if self.precision is not None:
+                resultado = yield from promediador.measure_async(self.leer)
+                logger.debug("{} lecturas en {}".format(resultado.reads,
+                                                        resultado.speed))
+                cv[ii, :] = resultado.value
+                if self.lcr is self.gwinstek:
+                    cv[ii, 1] = 1. / cv[ii, 1]
+            elif self.lcr is self.gwinstek:
                 cv[ii,:] = yield from self.lcr.refresh_async('measure')
                 cv[ii,1] = 1. / cv[ii, 1]
             else:
                 for jj in range(self.npromedios):
-                    temp = yield from self.lcr.refresh_async('measure')
+                    temp = yield from self.lcr.measure_async()
                     cv[ii, :] += temp
                 cv[ii, :] /= self.npromedios
         yield from self.hp.update_async(bias_voltage = Q_(0, 'V'))
-        vsrc_learn = yield from self.hp.refresh_async('learn')
+        vsrc_learn = yield from self.hp.relearn_async()
         freq, circ, drive = yield from self.lcr.refresh_async(['frequency',
             'equivalent_circuit', 'drive_level'])
         matriz_learn = yield from self.matriz.refresh_async('status')
@@ -148,16 +168,26 @@ class CV_GUI(base):
 {args}
 Bias: {vsrc}
 LCR: {circ} {freq} {drive}
+Precisión: {precision}
 Matriz: {matriz}
 Tensión [V]\tC [F]\tG [S]""".format(args = " ".join(sys.argv),
             vsrc = vsrc_learn, circ = circ, freq = freq, drive = drive,
-            matriz = matriz_learn)
+            precision = self.precision, matriz = matriz_learn)
         np.savetxt(filename, np.column_stack((tensiones, cv)), header=cabecera)
 
+    @asyncio.coroutine
+    def leer(self):
+        if self.lcr is self.hp:
+            return (yield from self.hp.measure_async())
+        return (yield from self.lcr.refresh_async('measure'))
+
     @asyncio.coroutine
     def terminar(self):
         yield from self.matriz.reset_async()
         yield from self.hp.update_async(bias_voltage = Q_(0, 'V'))
+        if self.velocidad is not None:
+            yield from self.lcr.update_async(speed = self.velocidad)
+            self.velocidad = None
 
     @pyqtSlot()
     def on_detener_clicked(self):
@@ -175,7 +205,6 @@ Tensión [V]\tC [F]\tG [S]""".format(args = " ".join(sys.argv),
             self.setMidiendo(False)
 
 if __name__ == '__main__':
-    import sys
     from PyQt4.QtGui import QApplication
     from PyQt4.QtCore import QCoreApplication
     QCoreApplication.setOrganizationName('LFDM')
@@ -4,14 +4,121 @@ import asyncio
 import logging
 import numpy as np
 
+from collections import namedtuple
+
+from gwinstekgds2062 import AcquisitionError, Waveform
+from calibracion_osc import TablaTiempos
+
 logger = logging.getLogger(__name__)
 
+class PlanConfiguracion(object):
+    """Ajustes del generador y el osciloscopio durante un barrido
+
+    Compara cada ajuste pedido con el último valor conocido del instrumento
+    y manda sólo los que cambian, para saber si hubo cambios. Los setters de
+    lantz ya saltean los valores iguales al cache, así que eso no ahorra
+    transacciones: ahorradas cuenta sólo los RUN evitados y las lecturas de
+    flancos, niveles y ancho que se reemplazaron por el cache."""
+
+    def __init__(self):
+        self.enviadas = 0
+        self.ahorradas = 0
+
+    @staticmethod
+    def igual(actual, nuevo):
+        try:
+            return bool(actual == nuevo)
+        except Exception:
+            return False
+
+    @asyncio.coroutine
+    def aplicar(self, instrumento, ajustes):
+        """Manda los ajustes que cambian, devuelve si hubo alguno"""
+        cambios = dict()
+        for nombre, valor in ajustes.items():
+            actual = instrumento.recall(nombre)
+            if isinstance(valor, dict):
+                if not isinstance(actual, dict):
+                    actual = dict()
+                valor = {clave: vv for clave, vv in valor.items()
+                         if not self.igual(actual.get(clave), vv)}
+                if valor:
+                    cambios[nombre] = valor
+            elif not self.igual(actual, valor):
+                cambios[nombre] = valor
+        if cambios:
+            self.enviadas += len(cambios)
+            yield from instrumento.update_async(cambios)
+        return bool(cambios)
+
+
+class Acumulador(object):
+    """Suma y suma de cuadrados de los disparos de un canal
+
+    Guarda sólo las sumas (int32 e int64) de las muestras crudas, no cada
+    disparo."""
+
+    def __init__(self, waveform):
+        self.modelo = waveform
+        self.suma = np.zeros(len(waveform), dtype=np.int32)
+        self.cuadrados = np.zeros(len(waveform), dtype=np.int64)
+        self.n = 0
+
+    def agregar(self, raw):
+        self.suma += raw
+        raw = raw.astype(np.int64)
+        raw *= raw
+        self.cuadrados += raw
+        self.n += 1
+
+    def media_cruda(self):
+        return self.suma / self.n
+
+    def varianza_cruda(self):
+        media = self.media_cruda()
+        return np.clip((self.cuadrados - self.n * media * media) /
+                       max(self.n - 1, 1), 0, None)
+
+    def distancia(self, raw):
+        """Distancia rms de raw a la media, en desvíos esperados"""
+        # Al menos una cuenta, el ruido de cuantización
+        esperada = max(np.sqrt(self.varianza_cruda().mean() *
+                               (1 + 1 / self.n)), 1.)
+        return np.sqrt(np.mean((raw - self.media_cruda()) ** 2)) / esperada
+
+    def waveform(self, raw, offset):
+        return Waveform(raw.astype(np.float32), self.modelo.scale,
+                        self.modelo.dt, offset, self.modelo.t0,
+                        self.modelo.dtype)
+
+    def media(self):
+        return self.waveform(self.media_cruda(), self.modelo.offset)
+
+    def desvio(self):
+        return self.waveform(np.sqrt(self.varianza_cruda()), 0.)
+
+
+class PulsoPromediado(namedtuple('PulsoPromediado',
+                                 'media desvio disparos rechazados')):
+    """media y desvio son, como lo que devuelve pulso, una lista con un
+    diccionario canal: Waveform por flanco"""
+
+
 class CV_Pulsada(object):
     SETUP_SUBIDA = 1
     SETUP_BAJADA = 2
 
     # Máximo ancho de pulso del generador
     generador_max = Q_(950, 'ms')
+    # Tiempo extra para que el osciloscopio se arme después de RUN
+    margen_armado = Q_(20, 'ms')
+    # Tiempo extra para completar la captura después del flanco
+    margen_captura = Q_(100, 'ms')
+    # Veces que se repite un pulso que el osciloscopio no capturó
+    reintentos = 3
+    # Esperas medidas con calibracion_osc.py; para las combinaciones que no
+    # estén se usan los márgenes
+    calibracion = 'calibracion_osc.json'
 
     def __init__(self, generador, osciloscopio):
         self.gen = generador
@@ -19,35 +126,68 @@ class CV_Pulsada(object):
         self.osc = osciloscopio
         self.osc.refresh()
         self.epsilon = .05
+        self.tiempos = TablaTiempos(self.calibracion)
+        self.plan = PlanConfiguracion()
+        # Si el osciloscopio está esperando un disparo desde el último RUN
+        self.osc_armado = False
 
-    @asyncio.coroutine
-    def setAncho(self, ancho, capturar_subida=True, capturar_bajada=True):
-        if not (capturar_subida or capturar_bajada):
-            raise Exception('No se pidió un flanco para capturar')
-        leading, trailing = yield from self.gen.refresh_async(
-                ['leading_edge', 'trailing_edge'])
-        self.manual = ancho > self.generador_max
-        if self.manual:
-            yield from self.gen.update_async(trigger_mode = 'external_width')
+    def configuracion(self, ancho, capturar_subida=True,
+                      capturar_bajada=True):
+        """Modo manual y ajustes del generador y del osciloscopio para ancho"""
+        # Los flancos sólo cambian con update, que actualiza el cache
+        leading = self.gen.recall('leading_edge')
+        trailing = self.gen.recall('trailing_edge')
+        manual = ancho > self.generador_max
+        if manual:
+            gen = dict(trigger_mode = 'external_width')
         else:
-            yield from self.gen.update_async(width = ancho,
-                    trigger_mode = 'trigger')
-        settings = None
-        if capturar_subida and capturar_bajada and not self.manual:
+            gen = dict(width = ancho, trigger_mode = 'trigger')
+        if capturar_subida and capturar_bajada and not manual:
             # Configurar osciloscopio para capturar todo
-            # Sin RUN actualiza el zoom en vez de la escala de adquisición
-            settings = dict(delay = .5 * ancho, time_scale = 
+            osc = dict(delay = .5 * ancho, time_scale = 
                     self.osc.fit_time(ancho + .5 * (leading + trailing)))
         else:
-            settings = dict(delay=Q_(0, 's'),
+            osc = dict(delay=Q_(0, 's'),
                     time_scale = self.osc.fit_time(leading))
             if capturar_subida:
-                settings['trigger_slope'] = 'rising'
+                osc['trigger_slope'] = 'rising'
             else:
-                settings['trigger_slope'] = 'falling'
+                osc['trigger_slope'] = 'falling'
+        return manual, gen, osc
+
+    def ordenar(self, pedidos):
+        """Orden conveniente para medir pedidos, lista de (ancho,
+        capturar_subida, capturar_bajada)
+
+        Devuelve los índices de pedidos agrupados por modo del generador,
+        flanco de disparo y escala de tiempo del osciloscopio, así dentro de
+        cada grupo sólo cambian el ancho y el delay."""
+        def clave(ii):
+            manual, gen, osc = self.configuracion(*pedidos[ii])
+            return (manual, osc.get('trigger_slope', ''),
+                    osc['time_scale'].to('s').magnitude,
+                    pedidos[ii][0].to('s').magnitude)
+        return sorted(range(len(pedidos)), key=clave)
+
+    @asyncio.coroutine
+    def setAncho(self, ancho, capturar_subida=True, capturar_bajada=True):
+        if not (capturar_subida or capturar_bajada):
+            raise Exception('No se pidió un flanco para capturar')
+        self.manual, gen, settings = self.configuracion(ancho,
+                capturar_subida, capturar_bajada)
+        # configuracion usa los flancos del cache en vez de leerlos
+        self.plan.ahorradas += 2
+        yield from self.plan.aplicar(self.gen, gen)
         # Sin RUN actualiza el zoom en vez de la escala de adquisición
-        yield from self.osc.run_async()
-        yield from self.osc.update_async(settings)
+        if self.osc_armado:
+            self.plan.ahorradas += 1
+        else:
+            yield from self.osc.run_async()
+            self.osc_armado = True
+            self.armado = time.time()
+        if (yield from self.plan.aplicar(self.osc, settings)):
+            # Vuelve a llenar la parte previa al disparo
+            self.armado = time.time()
         self._ancho = ancho
         self.capturar_bajada = capturar_bajada
         self.capturar_subida = capturar_subida
@@ -59,19 +199,121 @@ class CV_Pulsada(object):
     def pulso(self):
         """Genera un pulso de ancho configurable
 
+        Si el osciloscopio no captura, lo vuelve a armar y repite el pulso
+        hasta reintentos veces.
         La perilla LEVEL del generador debe estar hacia el límite izquierdo"""
+        for intento in range(self.reintentos + 1):
+            if intento:
+                logger.warning('Captura fallida, reintento %d', intento)
+                yield from self.rearmar()
+            try:
+                if self.manual:
+                    ret = yield from self.pulso_manual()
+                else:
+                    ret = yield from self.pulso_normal()
+                return ret
+            except AcquisitionError:
+                pass
+        raise AcquisitionError('No se capturó el pulso en {} intentos'.format(
+            self.reintentos + 1))
+
+    @asyncio.coroutine
+    def pulso_promediado(self, disparos, rechazo=None, pausa=None,
+                         minimo=3):
+        """Promedia disparos pulsos, muestra a muestra
+
+        Con rechazo, descarta los disparos que se alejan de la media más de
+        rechazo veces el desvío esperado (se evalúa desde minimo disparos
+        aceptados). pausa es la espera entre disparos."""
+        acumuladores = None
+        disparos_aceptados = 0
+        rechazados = 0
+        for ii in range(disparos):
+            if ii:
+                if pausa is not None:
+                    yield from self.sleep(pausa)
+                yield from self.rearmar()
+            flancos = yield from self.pulso()
+            if acumuladores is None:
+                acumuladores = [{canal: Acumulador(waveform)
+                                 for canal, waveform in flanco.items()}
+                                for flanco in flancos]
+            elif rechazo is not None and disparos_aceptados >= minimo:
+                distancia = max(acumulador.distancia(flanco[canal].raw)
+                                for flanco, acumulado in zip(flancos,
+                                                             acumuladores)
+                                for canal, acumulador in acumulado.items())
+                if distancia > rechazo:
+                    logger.info('Disparo %d rechazado, a %.1f desvíos',
+                                ii, distancia)
+                    rechazados += 1
+                    continue
+            for flanco, acumulado in zip(flancos, acumuladores):
+                for canal, acumulador in acumulado.items():
+                    acumulador.agregar(flanco[canal].raw)
+            disparos_aceptados += 1
+        return PulsoPromediado(
+            [{canal: acumulador.media()
+              for canal, acumulador in acumulado.items()}
+             for acumulado in acumuladores],
+            [{canal: acumulador.desvio()
+              for canal, acumulador in acumulado.items()}
+             for acumulado in acumuladores],
+            disparos_aceptados, rechazados)
+
+    @asyncio.coroutine
+    def rearmar(self):
+        """Vuelve al estado previo al pulso y arma el osciloscopio"""
         if self.manual:
-            ret = yield from self.pulso_manual()
+            yield from self.gen.update_async(trigger_control = 'negative')
+            yield from self.osc.update_async(trigger_slope = 'rising'
+                    if self.capturar_subida else 'falling',
+                    invert = {2: False})
+        yield from self.osc.run_async()
+        self.osc_armado = True
+        self.armado = time.time()
+
+    @asyncio.coroutine
+    def esperar_pretrigger(self):
+        """Espera que el osciloscopio llene la parte previa al disparo"""
+        time_scale = self.osc.recall('time_scale')
+        armado = self.tiempos.armado(self.osc.recall('record_length'),
+                                     time_scale)
+        if armado is None:
+            pretrigger = .5 * time_scale * self.osc.xdivisions + \
+                    self.margen_armado
+        else:
+            pretrigger = Q_(armado, 's')
+        restante = pretrigger - self.osc.recall('delay') - \
+                Q_(time.time() - self.armado, 's')
+        if restante > Q_(0, 's'):
+            yield from self.sleep(restante)
+
+    @asyncio.coroutine
+    def esperar_captura(self):
+        """Espera que termine el disparo único, sin sobrepasar la ventana"""
+        time_scale = self.osc.recall('time_scale')
+        captura = self.tiempos.captura(self.osc.recall('record_length'),
+                                       time_scale)
+        if captura is None:
+            ventana = self.osc.xdivisions * time_scale + self.margen_captura
         else:
-            ret = yield from self.pulso_normal()
-        return ret
+            # La calibración es con delay nulo
+            ventana = 2 * Q_(captura, 's') + abs(self.osc.recall('delay'))
+        listo = yield from self.osc.wait_acquisition_async(
+                ventana.to('s').magnitude)
+        if not listo:
+            raise AcquisitionError('El osciloscopio no disparó')
+        self.osc_armado = False
 
     @asyncio.coroutine
     def configurar(self):
         yield from self.gen.refresh_async()
         yield from self.osc.refresh_async()
-        high, low, leading, trailing = yield from self.gen.refresh_async(
-                ['high_level', 'low_level', 'leading_edge', 'trailing_edge'])
+        self.plan = PlanConfiguracion()
+        # Niveles y flancos ya leídos por refresh_async
+        self.plan.ahorradas += 4
+        high, low = self.gen.recall('high_level'), self.gen.recall('low_level')
         avg = high + low
         span = 2. * (high - low)
         yield from self.gen.update_async(trigger_control = 'negative')
@@ -83,6 +325,7 @@ class CV_Pulsada(object):
                 record_length=1, voltage_scale={1: self.osc.fit_voltage(span)},
                 offset={1: -avg}, invert = {2: False})
         yield from self.osc.stop_async()
+        self.osc_armado = False
         yield from self.sleep(Q_(0.1, 's'))
 
     @asyncio.coroutine
@@ -92,18 +335,20 @@ class CV_Pulsada(object):
         trailing = self.gen.recall('trailing_edge')
         #yield from self.osc.recall_setup_async(self.SETUP_SUBIDA)
         # Evito glitches configurando en este orden
+        yield from self.esperar_pretrigger()
         beginning = time.time()
         yield from self.gen.update_async(trigger_control = 'positive')
-        yield from self.sleep(self.osc.xdivisions *
-                self.osc.recall('time_scale') + Q_(0, 'ms'))
         # El instrumento interpreta el ancho como ancho altura mitad
         # Imito este comportamiento
         if self.capturar_subida:
+            yield from self.esperar_captura()
             subida_raw = yield from self.osc.acquire_async([1,2], False)
         #yield from self.osc.recall_setup_async(self.SETUP_BAJADA)
         yield from self.osc.update_async(trigger_slope='falling',
                 invert = { 2: True})
         yield from self.osc.run_async()
+        self.osc_armado = True
+        self.armado = time.time()
         delay = self._ancho + .5 * (leading - trailing) - Q_(time.time() 
                 - beginning, 's')
         if delay < Q_(0, 's'):
@@ -111,28 +356,26 @@ class CV_Pulsada(object):
         else:
             yield from self.sleep(delay)
         yield from self.gen.update_async(trigger_control = 'negative')
-        yield from self.sleep(self.osc.xdivisions *
-                self.osc.recall('time_scale') + Q_(0, 'ms'))
         if self.capturar_bajada:
-            bajada = yield from self.osc.acquire_async([1,2])
+            yield from self.esperar_captura()
+            bajada = yield from self.osc.acquire_async([1,2], lazy=True)
             flancos.append(bajada)
+        # El flanco de bajada completa el disparo único aunque no se capture
+        self.osc_armado = False
         yield from self.osc.update_async(trigger_slope='rising', 
                 invert = {2: False})
         if self.capturar_subida:
-            flancos.insert(0, self.osc.process_data(subida_raw))
+            flancos.insert(0, self.osc.process_data(subida_raw, lazy=True))
         return flancos
 
     @asyncio.coroutine
     def pulso_normal(self):
-        # Para no pedirlo en medio del pulso
-        leading, trailing, width = yield from self.gen.refresh_async(
-                ['leading_edge', 'trailing_edge', 'width'])
-        yield from self.sleep(.5 * self.osc.recall('time_scale') *
-                self.osc.xdivisions - self.osc.recall('delay') + Q_(200, 'ms'))
+        # Flancos y ancho salen del cache, no se leen antes de cada pulso
+        self.plan.ahorradas += 3
+        yield from self.esperar_pretrigger()
         yield from self.gen.trigger_async()
-        yield from self.sleep(self.osc.xdivisions *
-                self.osc.recall('time_scale'))
-        pulso = yield from self.osc.acquire_async([1,2])
+        yield from self.esperar_captura()
+        pulso = yield from self.osc.acquire_async([1,2], lazy=True)
         return (pulso,)
 
     @asyncio.coroutine
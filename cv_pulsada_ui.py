@@ -3,10 +3,10 @@ from gwinstekgds2062 import GwinstekGDS2062
 from PyQt4.uic import loadUiType
 from PyQt4.QtCore import pyqtSlot
 from lantz import Q_
+import asyncio
 import logging
 import os
-import numpy as np
-from matplotlib import pyplot as plt
+import time
 
 from lantzinitializedialog import LantzInitializeDialog
 from savesettings import SaveSettings
@@ -14,12 +14,29 @@ from autoincrement_file import get_save_filename
 from util import logspace
 from taskwrap import taskwrap
 from cv_pulsada import CV_Pulsada
+from waveformstore import WaveformStore
+from preview import PreviewRenderer
 
 logger = logging.getLogger(__name__)
 
 form, base = loadUiType('cv_pulsada.ui')
 
 class CV_Pulsada_UI(base):
+    # Comprimir las capturas guardadas (más lento, ~2x más chico)
+    comprimir = False
+    # Vistas previas PNG de cada flanco: tamaño [pulgadas] y dpi; con
+    # vista_previa = None no se dibujan. Si hay muchas pendientes se saltean
+    vista_previa = (18, 9)
+    dpi_vista_previa = 100
+    # Pulsos promediados por ancho; con más de uno se guardan también los
+    # desvíos. Se descartan los disparos a más de rechazo desvíos de la media
+    disparos = 1
+    rechazo = None
+    # Espera mínima entre pulsos para que el dispositivo se relaje
+    relajacion = Q_(1, 's')
+    # Pulsos medidos que pueden esperar a ser guardados
+    cola_guardado = 4
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.ui = form()
@@ -36,6 +53,10 @@ class CV_Pulsada_UI(base):
             ('tfinal', 'text'),
             ('guardar_primeros', 'text'),
             ('puntos_por_decada', 'text')], self)
+        self.vistas = None
+        if self.vista_previa is not None:
+            self.vistas = PreviewRenderer(self.vista_previa,
+                                          self.dpi_vista_previa)
         init = LantzInitializeDialog(self.instrumentos, parent=self)
         init.finished.connect(self.on_init_finished)
         init.show()
@@ -48,6 +69,8 @@ class CV_Pulsada_UI(base):
 
     def closeEvent(self, event):
         self.savesettings.save()
+        if self.vistas is not None:
+            self.vistas.close()
         super().closeEvent(event)
 
     @pyqtSlot()
@@ -74,44 +97,103 @@ class CV_Pulsada_UI(base):
                              int(self.ui.puntos_por_decada.text())), 's')
         logger.debug('Midiendo %s', str(anchos))
         os.mkdir(dirname)
+        # Todas las capturas en un archivo; exportar a texto con
+        # python waveformstore.py
+        almacen = WaveformStore(os.path.join(dirname, 'pulsos.cvp'), 'a',
+                                self.comprimir)
+        try:
+            yield from self.barrer(anchos, dirname, almacen)
+        finally:
+            almacen.close()
+
+    @asyncio.coroutine
+    def barrer(self, anchos, dirname, almacen):
+        """Mide los anchos mientras otra tarea guarda los pulsos anteriores
+
+        La configuración del próximo ancho se hace durante la relajación del
+        dispositivo. Si hay cola_guardado pulsos sin guardar, la medición
+        espera."""
         yield from self.cv.configurar()
         yield from self.gen.update_async(enable=True)
+        fin_pulso = time.time()
+        idn = self.osc.idn
         guardar_primeros = int(self.ui.guardar_primeros.text())
-        for ii, tt in enumerate(anchos):
-            logger.debug('%02d / %02d: %s', ii + 1, len(anchos), str(tt))
-            yield from self.cv.setAncho(tt, True, ii < guardar_primeros or 
+        pedidos = [(tt, True, ii < guardar_primeros or
                     tt > self.cv.generador_max)
-            yield from self.cv.sleep(Q_(1, 's'))
-            pulso = yield from self.cv.pulso()
-            comments = """\
+                   for ii, tt in enumerate(anchos)]
+        cola = asyncio.Queue(maxsize=self.cola_guardado)
+        guardado = asyncio.get_event_loop().create_task(
+                self.guardar(cola, dirname, almacen))
+        try:
+            # Se mide en el orden que menos reconfigura los instrumentos,
+            # pero cada pulso se guarda con su índice en el barrido
+            for nn, ii in enumerate(self.cv.ordenar(pedidos)):
+                tt = anchos[ii]
+                logger.debug('%02d / %02d: %s', nn + 1, len(anchos), str(tt))
+                yield from self.cv.setAncho(*pedidos[ii])
+                generador = yield from self.gen.refresh_async('settings')
+                # Relajación desde el pulso anterior
+                yield from self.cv.sleep(self.relajacion -
+                                         Q_(time.time() - fin_pulso, 's'))
+                desvios = None
+                disparos = 1
+                if self.disparos > 1:
+                    promedio = yield from self.cv.pulso_promediado(
+                            self.disparos, self.rechazo, self.relajacion)
+                    pulso, desvios = promedio.media, promedio.desvio
+                    disparos = promedio.disparos
+                    logger.debug('%d disparos, %d rechazados', disparos,
+                                 promedio.rechazados)
+                else:
+                    pulso = yield from self.cv.pulso()
+                fin_pulso = time.time()
+                if guardado.done():
+                    # Falló el guardado, no tiene sentido seguir midiendo
+                    guardado.result()
+                comments = """\
 CV Pulsada de {} a {}, {} puntos por década
 Generador: {}
 Osciloscopio: {}
 Este es el pulso {}, de ancho {:.2e~}
 Tiempo [s]\tCanal 1 [V]\n""".format(
-                self.ui.inicial.text(), self.ui.tfinal.text(),
-                self.ui.puntos_por_decada.text(), self.gen.settings, 
-                self.osc.idn, ii, tt)
-            for jj, flanco in enumerate(pulso):
-                prefijo = os.path.join(dirname,
-                        '{:03d}_{:.2e~}_{:d}'.format(ii, tt, jj))
-                tiempo = pulso[jj]['time'].to('s').magnitude
-                canal1 = pulso[jj][1].to('V').magnitude
-                canal2 = pulso[jj][2].to('V').magnitude
-                np.savetxt(prefijo + '.txt', np.column_stack((tiempo, canal1,
-                    canal2)), header=comments)
-                plt.figure(figsize=(18,9))
-                plt.subplot(1,2,1)
-                plt.plot(tiempo, canal1)
-                plt.xlabel('Tiempo [s]')
-                plt.ylabel('Tensión [V]')
-                plt.subplot(1,2,2)
-                plt.plot(tiempo, canal2)
-                plt.xlabel('Tiempo [s]')
-                plt.ylabel('Tensión [V]')
-                plt.savefig(prefijo + '.png')
-                plt.clf()
+                    self.ui.inicial.text(), self.ui.tfinal.text(),
+                    self.ui.puntos_por_decada.text(), generador, idn, ii, tt)
+                encabezado = dict(pulse=ii, width=tt.to('s').magnitude,
+                                  comments=comments, generator=generador,
+                                  scope=idn)
+                yield from cola.put((ii, tt, pulso, desvios, disparos,
+                                     encabezado))
+        finally:
+            if not guardado.done():
+                yield from cola.put(None)
+            yield from guardado
+        logger.info('Ajustes enviados: %d, transacciones ahorradas: %d',
+                    self.cv.plan.enviadas, self.cv.plan.ahorradas)
+        if self.vistas is not None and self.vistas.dropped:
+            logger.info('%d vistas previas salteadas', self.vistas.dropped)
+
+    @asyncio.coroutine
+    def guardar(self, cola, dirname, almacen):
+        """Guarda los pulsos de la cola hasta recibir None"""
+        loop = asyncio.get_event_loop()
+        while True:
+            pedido = yield from cola.get()
+            if pedido is None:
+                return
+            # Escalar, escribir y dibujar fuera del lazo de eventos
+            yield from loop.run_in_executor(None, self.guardar_pulso,
+                                            dirname, almacen, *pedido)
 
+    def guardar_pulso(self, dirname, almacen, ii, tt, pulso, desvios,
+                      disparos, encabezado):
+        for jj, flanco in enumerate(pulso):
+            almacen.append(flanco, edge=jj, shots=disparos, **encabezado)
+            if desvios is not None:
+                almacen.append(desvios[jj], edge=jj, shots=disparos,
+                               stat='desvio', **encabezado)
+            if self.vistas is not None:
+                self.vistas.submit(os.path.join(dirname,
+                    '{:03d}_{:.2e~}_{:d}.png'.format(ii, tt, jj)), flanco)
 
 if __name__ == '__main__':
     import sys
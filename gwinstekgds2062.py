@@ -2,7 +2,8 @@ from lantz import Feat, DictFeat, Action, Q_
 from lantz.visa import MessageVisaDriver
 from lantz.ui.app import start_test_app
 from stringparser import Parser
-from struct import unpack
+from struct import unpack_from
+import asyncio
 import numpy as np
 from time import sleep, time
 import pyvisa.constants as vi
@@ -34,6 +35,58 @@ def MyChanFeat(command, fmt, *args, **kwargs):
     return DictFeat(*args, fset=setter, fget=getter,
             keys=[1, 2], read_once=True, **kwargs)
 
+class AcquisitionError(RuntimeError):
+    """The single shot did not capture anything"""
+
+
+class Waveform(object):
+    """One channel of an acquisition, kept as the raw int16 samples
+
+    volts = raw * scale + offset and time = t0 + index * dt are computed
+    when asked for, as dtype. Slicing returns a Waveform sharing the
+    samples; an integer index returns the volts of one sample."""
+
+    def __init__(self, raw, scale, dt, offset=0., t0=0., dtype=np.float64):
+        self.raw = raw
+        self.scale = scale
+        self.dt = dt
+        self.offset = offset
+        self.t0 = t0
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.raw[index] * self.scale + self.offset
+        start, stop, step = index.indices(len(self.raw))
+        return Waveform(self.raw[index], self.scale, self.dt * step,
+                        self.offset, self.t0 + start * self.dt, self.dtype)
+
+    @property
+    def volts(self):
+        ret = self.raw.astype(self.dtype)
+        ret *= self.scale
+        ret += self.offset
+        return ret
+
+    @property
+    def time(self):
+        ret = np.arange(len(self.raw), dtype=self.dtype)
+        ret *= self.dt
+        ret += self.t0
+        return ret
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.volts
+        return self.volts.astype(dtype)
+
+    def __repr__(self):
+        return '<Waveform {} samples, dt={:g} s>'.format(len(self), self.dt)
+
+
 class GwinstekGDS2062(MessageVisaDriver):
     channels = [1, 2]
     xdivisions = 20 # Only displays 10 on screen
@@ -96,6 +149,33 @@ class GwinstekGDS2062(MessageVisaDriver):
     def stop(self):
         self.send(':stop')
 
+    @Feat()
+    def acquisition_done(self):
+        """Whether the acquisition (a single shot) completed"""
+        return self.query(':acquire:state?').strip() == '1'
+
+    # Seconds between :acquire:state? polls
+    ACQUISITION_POLL = .005
+
+    def wait_acquisition(self, timeout):
+        """Wait until the acquisition completed, False after timeout s"""
+        deadline = time() + timeout
+        while not self.acquisition_done:
+            if time() >= deadline:
+                return False
+            sleep(self.ACQUISITION_POLL)
+        return True
+
+    @asyncio.coroutine
+    def wait_acquisition_async(self, timeout):
+        """Like wait_acquisition, giving the event loop back while polling"""
+        deadline = time() + timeout
+        while not self.acquisition_done:
+            if time() >= deadline:
+                return False
+            yield from asyncio.sleep(self.ACQUISITION_POLL)
+        return True
+
     setup_memories = list(range(1, 21))
     @Action()
     def recall_setup(self, memory):
@@ -109,32 +189,88 @@ class GwinstekGDS2062(MessageVisaDriver):
             raise RuntimeError('Invalid memory: {}'.format(memory))
         self.send(':memory{}:save:setup'.format(memory))
 
+    # Waveforms are read into reusable buffers, two per channel so that an
+    # unprocessed acquisition survives the next one of the same channel
+    BUFFERS_PER_CHANNEL = 2
+    _buffers = None
+
+    def block_buffer(self, channel, size):
+        """Next reusable buffer of channel, as a memoryview of size bytes"""
+        if self._buffers is None:
+            self._buffers = dict()
+        ring, index = self._buffers.get(channel, ([], 0))
+        if len(ring) < self.BUFFERS_PER_CHANNEL:
+            ring.append(bytearray(size))
+        elif len(ring[index]) < size:
+            ring[index] = bytearray(size)
+        buf = ring[index]
+        self._buffers[channel] = (ring, (index + 1) % self.BUFFERS_PER_CHANNEL)
+        return memoryview(buf)[:size]
+
+    def read_exactly(self, view):
+        """Fill view from the instrument, however the data is chunked
+
+        read_raw keeps reading until the end of the message whatever size it
+        is given, so exact counts are read with the VISA library. A read may
+        also stop early at a termination byte inside the binary data."""
+        resource = self.resource
+        filled = 0
+        while filled < len(view):
+            chunk, status = resource.visalib.read(resource.session,
+                                                  len(view) - filled)
+            if not chunk:
+                raise RuntimeError('No data after {} of {} bytes'.format(
+                    filled, len(view)))
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+        return view
+
+    def read_block_into(self, channel):
+        """Read a #<digits><length> block into a buffer of channel"""
+        header = self.read_exactly(memoryview(bytearray(2)))
+        if header[0] != ord('#'):
+            raise RuntimeError('Bad block header: {}'.format(bytes(header)))
+        length = int(bytes(self.read_exactly(memoryview(bytearray(
+            int(bytes(header[1:])))))))
+        return self.read_exactly(self.block_buffer(channel, length))
+
     @Action()
-    def acquire(self, channels, process=True):
+    def acquire(self, channels, process=True, lazy=False, dtype=np.float64):
+        """Waveforms of channels, see process_data. Without process, the raw
+        blocks stay valid until two more acquisitions of the same channel"""
         ret = []
         for channel in channels:
             if channel not in self.channels:
                 raise RuntimeError('Invalid channel: {}'.format(channel))
             self.send(':acquire{}:memory?'.format(channel))
             # Response format in programmer's manual page 29
-            data = self.read_block()
-            if all(dd == 0 for dd in data[8:]):
+            data = self.read_block_into(channel)
+            if not np.frombuffer(data, dtype='>i2', offset=8).any():
                 # Received all zeros
-                raise RuntimeError('Bad acquisition')
+                raise AcquisitionError('Bad acquisition')
             ret.append(data)
         if not process:
             return ret
         else:
-            return self.process_data(ret)
+            return self.process_data(ret, lazy, dtype)
 
-    def process_data(self, data):
+    def process_data(self, data, lazy=False, dtype=np.float64):
+        """Dictionary of channel: Waveform when lazy, otherwise of
+        channel: volts and 'time': seconds Quantities"""
         ret = dict()
         for dd in data:
             channel = dd[4]
-            deltaT = unpack('>f', dd[:4])
-            raw = np.frombuffer(dd[8:], dtype='>h')
-            ret[channel] = 10. * raw / 0x100 * self.voltage_scale[channel]
-        ret['time'] = Q_(deltaT * np.arange(len(raw)), 's')
+            deltaT, = unpack_from('>f', dd)
+            # 25.6 counts per division
+            scale = 10. / 0x100 * self.voltage_scale[channel].to('V').magnitude
+            ret[channel] = Waveform(np.frombuffer(dd, dtype='>i2', offset=8
+                                                  ).astype(np.int16),
+                                    scale, deltaT, dtype=dtype)
+        if lazy:
+            return ret
+        for channel, waveform in list(ret.items()):
+            ret[channel] = Q_(waveform.volts, 'V')
+        ret['time'] = Q_(waveform.time, 's')
         return ret
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 from lantz import Feat, Q_, Action
 from lantz.serial import SerialDriver
-import numpy as np
+
+from convergence import Convergence
 
 class GwinstekLCR8110G (SerialDriver):
     ENCODING = 'ascii'
@@ -43,14 +44,17 @@ class GwinstekLCR8110G (SerialDriver):
         return (first, second)
 
     @Action()
-    def measure_stable(self, epsilon=1e-2):
-        meas2 = self.measure
-        while True:
-            meas1 = meas2
-            meas2 = self.measure
-            if np.linalg.norm(np.subtract(meas2, meas1)) / np.linalg.norm(
-                    meas2) < epsilon:
-                return meas2
+    def measure_stable(self, epsilon=1e-2, atol=0., window=2, max_reads=50,
+                       timeout=None):
+        """Measure until both values settle, see Convergence. Logs a
+        warning when they do not; check last_convergence.converged"""
+        convergence = Convergence(window, epsilon, atol, max_reads, timeout)
+        self.last_convergence = convergence.run(lambda: self.measure)
+        if not self.last_convergence.converged:
+            self.log_warning('Measurement did not settle after {} reads, '
+                             'spread {}'.format(self.last_convergence.reads,
+                                                self.last_convergence.spread))
+        return self.last_convergence.value
 
     @Feat(values=dict(C=0, L=1, X=2, B=3, Z=4, Y=5))
     def function1(self):
@@ -68,6 +72,9 @@ class GwinstekLCR8110G (SerialDriver):
     def function2(self, value):
         self.send(':meas:func:minor {:d}'.format(value))
 
+    # Fastest first, for PrecisionAverager
+    speeds = ['max', 'fast', 'med', 'slow']
+
     @Feat(values=dict(max=0, fast=1, med=2, slow=3))
     def speed(self):
         return self.query(':meas:speed?')
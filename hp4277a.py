@@ -1,27 +1,65 @@
 from lantz import Feat, Q_, Action, DictFeat
 from lantz.visa import GPIBVisaDriver
-from time import sleep
+from time import sleep, time
+import asyncio
 import numpy as np
+import pyvisa.constants as vi
+from pyvisa.errors import VisaIOError
 import re
 
+from convergence import Convergence
+
 class HP4277A (GPIBVisaDriver):
     RECV_TERMINATION = ''
     def initialize(self):
         super().initialize()
         # Set output format
-        self.send('F1')
+        self.send_setting('F', '1')
 
     #FR10.0ENA1B3C1D0F1M2P0R4S0T1U1V1X0BI+0.00EN
     learn_re = re.compile(r'FR([0-9.]+)ENA([1-5])B([1-3])C([1-3])D([01])'\
             'F([1-4])M([1-3])P([01])R([1-8])S([01])T([12])U([01])V([12])'\
             'X([01])BI([+\-0-9.]+)EN')
+    # Position of each setting in the learn tuple
+    learn_fields = dict(FR=0, A=1, B=2, C=3, D=4, F=5, M=6, P=7, R=8, S=9,
+                        T=10, U=11, V=12, X=13, BI=14)
+    # Seconds before the cached learn string is queried again
+    LEARN_MAX_AGE = 60.
+    # Settings the instrument rounds to its own resolution: after sending
+    # them the cached learn tuple is queried again
+    learn_rounded = ('FR', 'BI')
+    _learned = None
+    _learned_time = 0.
+
     @Feat()
     def learn(self):
-        return self.learn_re.match(self.learn_raw).groups()
+        """Settings tuple. Kept up to date by our own setters, so the LN
+        query is only repeated when older than LEARN_MAX_AGE"""
+        if self._learned is None or \
+                time() - self._learned_time > self.LEARN_MAX_AGE:
+            self.relearn()
+        return tuple(self._learned)
 
     @Feat()
     def learn_raw(self):
-        return self.query('LN')
+        raw = self.query('LN')
+        self._learned = list(self.learn_re.match(raw).groups())
+        self._learned_time = time()
+        return raw
+
+    @Action()
+    def relearn(self):
+        """Query the learn string again, e.g. after front panel changes"""
+        self.refresh('learn_raw')
+        return tuple(self._learned)
+
+    def send_setting(self, command, value, suffix=''):
+        """Send a setting and update the cached learn tuple"""
+        self.send(command + value + suffix)
+        if command in self.learn_rounded:
+            self._learned = None
+        elif self._learned is not None:
+            self._learned[self.learn_fields[command]] = value
 
     @Feat(units='V', limits=(-40, 40))
     def bias_voltage(self):
@@ -29,7 +67,7 @@ class HP4277A (GPIBVisaDriver):
 
     @bias_voltage.setter
     def bias_voltage(self, value):
-        self.send('BI{:+02.2f}EN'.format(value))
+        self.send_setting('BI', '{:+02.2f}'.format(value), 'EN')
 
     @Feat(units='kHz', limits=(10, 995))
     def frequency(self):
@@ -37,7 +75,7 @@ class HP4277A (GPIBVisaDriver):
 
     @frequency.setter
     def frequency(self, value):
-        self.send('FR{:3.1f}EN'.format(value))
+        self.send_setting('FR', '{:3.1f}'.format(value), 'EN')
 
     @Feat(values=dict(L='1', C='2', fastL='3', fastC='4', Z='5'))
     def functionA(self):
@@ -45,7 +83,7 @@ class HP4277A (GPIBVisaDriver):
 
     @functionA.setter
     def functionA(self, value):
-        self.send('A' + value)
+        self.send_setting('A', value)
 
     @Feat(values=dict(D='1', Q='2', ESR='3'))
     def functionB(self):
@@ -53,7 +91,7 @@ class HP4277A (GPIBVisaDriver):
 
     @functionB.setter
     def functionB(self, value):
-        self.send('B' + value)
+        self.send_setting('B', value)
 
     @Feat(values=dict(auto='1', series='2', parallel='3'))
     def equivalent_circuit(self):
@@ -61,7 +99,10 @@ class HP4277A (GPIBVisaDriver):
 
     @equivalent_circuit.setter
     def equivalent_circuit(self, value):
-        self.send('C' + value)
+        self.send_setting('C', value)
+
+    # Fastest first, for PrecisionAverager
+    speeds = ['fast', 'medium', 'slow']
 
     @Feat(values=dict(slow='1', medium='2', fast='3'))
     def speed(self):
@@ -69,7 +110,7 @@ class HP4277A (GPIBVisaDriver):
 
     @speed.setter
     def speed(self, value):
-        self.send('M' + value)
+        self.send_setting('M', value)
 
     @Feat(values=dict(off='0', on='1'))
     def autorange(self):
@@ -77,7 +118,7 @@ class HP4277A (GPIBVisaDriver):
 
     @autorange.setter
     def autorange(self, value):
-        self.send('U' + value)
+        self.send_setting('U', value)
 
     @Feat(values=dict(off='0', on='1'))
     def data_ready(self):
@@ -85,7 +126,7 @@ class HP4277A (GPIBVisaDriver):
 
     @data_ready.setter
     def data_ready(self, value):
-        self.send('D' + value)
+        self.send_setting('D', value)
 
     @Feat(values={'low': '1', 'high': '2'})
     def drive_level(self):
@@ -94,7 +135,7 @@ class HP4277A (GPIBVisaDriver):
 
     @drive_level.setter
     def drive_level(self, value):
-        self.send('V' + value)
+        self.send_setting('V', value)
 
     measure_re = re.compile(r'(?P<circuit_mode>[PS])(?P<statusA>[NDOUCB])'\
             '(?P<functionA>[LCZ])(?P<valueA>[+\-0-9.E]+)(\r\n|,)'\
@@ -116,41 +157,123 @@ class HP4277A (GPIBVisaDriver):
     def execute(self):
         self.send('EX')
 
-    @Feat(units='ohm')
-    def impedance(self):
-        self.functionA = 'Z'
-        self.execute()
-        # Wait for data ready
-        while self.read_status() & 1 == 0:
-            print(self.read_status())
-            pass
+    # Seconds between data ready polls: first, growth factor and longest
+    poll_interval = (.002, 1.5, .05)
+    # Seconds to wait for a measurement before giving up
+    MEASURE_TIMEOUT = 5.
+    _srq_enabled = False
+
+    def poll_intervals(self):
+        interval, factor, longest = self.poll_interval
+        while True:
+            yield interval
+            interval = min(interval * factor, longest)
+
+    def wait_data_ready(self, timeout=None):
+        """Wait for bit 0 of the status byte (data ready)
+
+        Waits for the service request when data_ready is on, otherwise
+        polls with a growing interval. Raises TimeoutError."""
+        if timeout is None:
+            timeout = self.MEASURE_TIMEOUT
+        deadline = time() + timeout
+        if self.data_ready == 'on':
+            if not self._srq_enabled:
+                self.resource.enable_event(vi.VI_EVENT_SERVICE_REQ,
+                                           vi.VI_QUEUE)
+                self._srq_enabled = True
+            # A queued request may be left from an earlier measurement
+            while self.read_status() & 1 == 0:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise TimeoutError('HP4277A: no data after {} s'.format(
+                        timeout))
+                try:
+                    self.resource.wait_on_event(vi.VI_EVENT_SERVICE_REQ,
+                                                int(remaining * 1e3) + 1)
+                except VisaIOError as e:
+                    if e.error_code != vi.VI_ERROR_TMO:
+                        raise
+            return
+        for interval in self.poll_intervals():
+            if self.read_status() & 1:
+                return
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise TimeoutError('HP4277A: no data after {} s'.format(
+                    timeout))
+            sleep(min(interval, remaining))
+
+    @asyncio.coroutine
+    def wait_data_ready_async(self, timeout=None):
+        """Like wait_data_ready, polling with asyncio.sleep so that other
+        instruments can use the event loop meanwhile"""
+        if timeout is None:
+            timeout = self.MEASURE_TIMEOUT
+        deadline = time() + timeout
+        for interval in self.poll_intervals():
+            if (yield from self.poll_data_ready_async()):
+                return
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise TimeoutError('HP4277A: no data after {} s'.format(
+                    timeout))
+            yield from asyncio.sleep(min(interval, remaining))
+
+    @Action()
+    def poll_data_ready(self):
+        """True when bit 0 of the status byte (data ready) is set"""
+        return bool(self.read_status() & 1)
+
+    def checked_display(self):
         disp = self.display()
         for dd in self.displays:
             if disp['status' + dd] != self.status_codes['normal']:
                 raise Exception('Status {}'.format(disp))
+        return disp
+
+    @Action()
+    def read_display(self):
+        """checked_display as an Action, to be read in the executor"""
+        return self.checked_display()
+
+    @Feat(units='ohm')
+    def impedance(self):
+        self.functionA = 'Z'
+        self.execute()
+        self.wait_data_ready()
+        disp = self.checked_display()
         ret = float(disp['valueA']) + 0j
-        ret *= np.exp(1j * deg2rad(float(disp['valueB'])))
+        ret *= np.exp(1j * np.deg2rad(float(disp['valueB'])))
         return ret
 
     @Feat()
     def measure(self):
         self.execute()
-        # Wait for data ready
-        while self.read_status() & 1 == 0:
-            sleep(.05)
-        disp = self.display()
-        for dd in self.displays:
-            if disp['status' + dd] != self.status_codes['normal']:
-                raise Exception('Status {}'.format(disp))
+        self.wait_data_ready()
+        disp = self.checked_display()
         return (float(disp['valueA']), float(disp['valueB']))
 
-    def measure_stable(self, epsilon=1e-2):
-        meas2 = self.measure
-        while True:
-            meas1 = meas2
-            meas2 = self.measure
-            if abs((meas1[0]-meas2[0])/meas2[0]) < epsilon:
-                return meas2
+    @asyncio.coroutine
+    def measure_async(self, timeout=None):
+        """Coroutine version of measure"""
+        yield from self.execute_async()
+        yield from self.wait_data_ready_async(timeout)
+        disp = yield from self.read_display_async()
+        return (float(disp['valueA']), float(disp['valueB']))
+
+    def measure_stable(self, epsilon=1e-2, atol=0., window=2, max_reads=50,
+                       timeout=None):
+        """Measure until display A settles, see Convergence. Logs a
+        warning when it does not; check last_convergence.converged"""
+        convergence = Convergence(window, epsilon, atol, max_reads, timeout,
+                                  components=[0])
+        self.last_convergence = convergence.run(lambda: self.measure)
+        if not self.last_convergence.converged:
+            self.log_warning('Display A did not settle after {} reads, '
+                             'spread {}'.format(self.last_convergence.reads,
+                                                self.last_convergence.spread))
+        return self.last_convergence.value
 
     def finalize(self):
         self.bias_voltage = Q_(0, 'V')
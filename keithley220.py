@@ -1,6 +1,8 @@
 from lantz import Feat, Q_, Action
 from lantz.visa import GPIBVisaDriver
 
+from util import set_raw_cache, refresh_snapshots
+
 class Keithley220 (GPIBVisaDriver):
     RECV_TERMINATION = '\r\n'
     SEND_TERMINATION = ''
@@ -11,13 +13,30 @@ class Keithley220 (GPIBVisaDriver):
         # Start on GPIB bus trigger
         self.send('G3T2X')
 
+    # Position of each value in the data string
+    data_fields = dict(current=0, voltage_limit=1, dwell_time=2, address=3)
+    # Position and type of each setting in the status string
+    status_fields = dict(output=(4, int), program=(8, str), range=(9, int))
+    snapshots = dict(status=list(status_fields), data=list(data_fields))
+
     @Feat()
     def data(self):
-        return list(map(float, self.recv().split(',')))
+        """Also fills the cache of every value in the data string"""
+        data = list(map(float, self.recv().split(',')))
+        for name, field in self.data_fields.items():
+            set_raw_cache(self, name, data[field])
+        return data
 
     @Feat()
     def status(self):
-        return '220' + self.query('U0X')
+        """Also fills the cache of every setting in the status string"""
+        status = '220' + self.query('U0X')
+        for name, (field, kind) in self.status_fields.items():
+            set_raw_cache(self, name, kind(status[field]))
+        return status
+
+    def refresh(self, keys=None):
+        return refresh_snapshots(self, keys, super().refresh)
 
     @Feat(values={True: 1, False: 0})
     def output(self):
@@ -95,6 +114,38 @@ class Keithley220 (GPIBVisaDriver):
     def display_address(self, value):
         self.send('L{:d}X'.format(value))
 
+    program_locations = 100
+
+    @Action()
+    def load_program(self, currents, dwell_time=None, fill=False):
+        """Store currents (and dwell time) in memory locations 1, 2, ...
+
+        Sends a single write, with one X per location so that each location
+        is executed on its own, and leaves the buffer address at 1, ready to
+        run a step or continuous program. Moving the buffer address sources
+        each location in single and step programs, so load with the output
+        off. With fill the last current also goes to every remaining
+        location, so a continuous program running past the end of currents
+        does not source what an earlier load left there."""
+        currents = Q_(currents).to('A').magnitude
+        if len(currents) > self.program_locations:
+            raise ValueError('At most {} locations'.format(
+                self.program_locations))
+        if fill and len(currents):
+            currents = list(currents) + [currents[-1]] * (
+                self.program_locations - len(currents))
+        dwell = ''
+        if dwell_time is not None:
+            dwell = 'W{:.3E}'.format(Q_(dwell_time).to('s').magnitude)
+        self.send(''.join('B{:d}I{:.3E}{}X'.format(ii + 1, current, dwell)
+                          for ii, current in enumerate(currents)) + 'B1X')
+
+    @Action()
+    def step(self):
+        """Bus trigger: advance one location in step program, start the
+        continuous program"""
+        self.trigger()
+
     def finalize(self):
         self.output = False
         super().finalize()
@@ -1,16 +1,23 @@
 from lantz import Feat, Q_, Action
 from lantz.visa import GPIBVisaDriver
 
+from convergence import Convergence
+from util import set_raw_cache, refresh_snapshots
+
 class Keithley617 (GPIBVisaDriver):
     RECV_TERMINATION = '\r\n'
     SEND_TERMINATION = ''
 
+    # Whether addressing the instrument to talk triggers a reading
+    talk_trigger = False
+
     def initialize(self):
         super().initialize()
         # Return data without prefix
         self.send('G1')
         # Continuous trigger on talk
-        self.send('T0')
+        self.send('T0X')
+        self.talk_trigger = True
 
     @Feat(values=dict(volts=0, amps=1, ohms=2, coulombs=3))
     def function(self):
@@ -20,33 +27,54 @@ class Keithley617 (GPIBVisaDriver):
     def function(self, func):
         self.send('F{}X'.format(func))
 
+    def select_function(self, function):
+        """Set function unless it is already the one in the cache"""
+        if self.recall('function') != function:
+            self.function = function
+
     @Feat(units='V')
     def voltage(self):
-        self.function = 'volts'
-        self.execute()
-        return self.recv()
+        self.select_function('volts')
+        return self.fetch()
 
     @Feat(units='C')
     def charge(self):
-        self.execute()
+        return self.fetch()
+
+    @Action()
+    def fetch(self):
+        """Read one value in the current function
+
+        In talk triggered mode (T0) the read itself starts the conversion, so
+        no X is needed"""
+        if not self.talk_trigger:
+            self.execute()
         return self.recv()
 
     @Action()
-    def stable_voltage(self, epsilon=.01):
-        ret = self.voltage
-        measurements = 0
-        while True:
-            last = ret
-            ret = self.voltage
-            if abs(last-ret)/ret < epsilon:
-                return (ret, measurements)
-            measurements += 1
+    def stable_voltage(self, epsilon=.01, atol=0., window=2, max_reads=100,
+                       timeout=None):
+        """Read voltage until the last window readings agree within
+        atol [V] + epsilon * |mean|. Returns (voltage, number of reads).
+
+        Logs a warning when max_reads or timeout is reached first; the full
+        ConvergenceResult is kept in last_convergence"""
+        convergence = Convergence(window, epsilon, atol, max_reads, timeout)
+        self.last_convergence = convergence.run(
+            lambda: self.voltage.to('V').magnitude)
+        if not self.last_convergence.converged:
+            self.log_warning('Voltage did not settle after {} reads, spread '
+                             '{} V'.format(self.last_convergence.reads,
+                                           self.last_convergence.spread))
+        return (Q_(self.last_convergence.value, 'V'),
+                self.last_convergence.reads)
 
     @Action()
     def execute(self):
         self.send('X')
 
-    @Feat(values=dict(auto=0))
+    # Range codes: R0 auto, R1 the lowest range of the function and up
+    @Feat(values=dict([('auto', 0)] + [(ii, ii) for ii in range(1, 12)]))
     def range(self):
         return int(self.status[4:6])
 
@@ -86,9 +114,29 @@ class Keithley617 (GPIBVisaDriver):
     def reading_mode(self, mode):
         self.send('B{}X'.format(mode))
 
+    # Position of each setting in the U0X status string
+    status_fields = dict(function=slice(3, 4), range=slice(4, 6),
+                         zero_check=slice(6, 7), zero_correct=slice(7, 8),
+                         reading_mode=slice(11, 12),
+                         display_mode=slice(13, 14))
+    snapshots = dict(status=list(status_fields))
+
     @Feat()
     def status(self):
-        return self.query('U0X')
+        """Also fills the cache of every setting in the status string
+
+        Settings with a code their Feat does not know are left uncached"""
+        status = self.query('U0X')
+        for name, field in self.status_fields.items():
+            try:
+                set_raw_cache(self, name, int(status[field]))
+            except ValueError:
+                self.log_warning('Unknown {} code in status {}'.format(
+                    name, status))
+        return status
+
+    def refresh(self, keys=None):
+        return refresh_snapshots(self, keys, super().refresh)
 
 if __name__ == '__main__':
     from lantz.log import log_to_screen, DEBUG
@@ -1,6 +1,8 @@
 from lantz import Feat, DictFeat, Q_, Action
 from lantz.visa import GPIBVisaDriver
 
+from util import refresh_snapshots
+
 columns = list(range(1,6))
 rows = list(range(1,5))
 class Keithley705 (GPIBVisaDriver):
@@ -15,6 +17,7 @@ class Keithley705 (GPIBVisaDriver):
             keys=[(col, row) for col in columns 
                              for row in rows])
     def channel(self, key):
+        col, row = key
         return self.query('B{:02d}{:01d}U0X'.format(col, row))[-1] == '1'
 
     @Action()
@@ -27,8 +30,39 @@ class Keithley705 (GPIBVisaDriver):
 
     @channel.setter
     def channel(self, key, value):
+        self.send(self.channel_command(key, value) + 'X')
+
+    @staticmethod
+    def channel_command(key, value):
         col, row = key
-        self.send('{}0{}{}X'.format(['N', 'C'][value], col, row))
+        return '{}0{}{}'.format(['N', 'C'][value], col, row)
+
+    # Crosspoints closed by each measurement setup
+    presets = dict(vi=[(1, 1), (1, 4), (4, 2), (4, 3), (4, 4), (2, 1)],
+                   cv=[(3, 2), (3, 3), (3, 4), (5, 1)])
+
+    @Action()
+    def apply_routing(self, channels):
+        """Close exactly these crosspoints (or those of a preset name) and
+        open the rest.
+
+        Only crosspoints whose cached state differs are sent, all in one
+        command with a single X."""
+        if isinstance(channels, str):
+            channels = self.presets[channels]
+        closed = set(channels)
+        cached = self.recall('channel')
+        if not isinstance(cached, dict):
+            cached = dict()
+        changes = [((col, row), (col, row) in closed)
+                   for col in self.columns for row in self.rows
+                   if cached.get((col, row)) is not ((col, row) in closed)]
+        if not changes:
+            return
+        self.send(''.join(self.channel_command(key, value)
+                          for key, value in changes) + 'X')
+        for key, value in changes:
+            self._lantz_features['channel'].set_cache(self, value, key)
 
     @Feat()
     def channels(self):
@@ -41,6 +75,12 @@ class Keithley705 (GPIBVisaDriver):
             self._lantz_features['channel'].set_cache(self, ret[key], key)
         return ret
 
+    # Every crosspoint comes from a single U1X query
+    snapshots = dict(channels=['channel'])
+
+    def refresh(self, keys=None):
+        return refresh_snapshots(self, keys, super().refresh)
+
     @Action()
     def execute(self):
         self.send('X')
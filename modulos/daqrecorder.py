@@ -0,0 +1,245 @@
+"""Record continuous AD acquisitions as raw codes
+
+A recording is a fixed size JSON header (channel list, gains, range,
+resolution, encoding, sample rate, start time) followed by the interleaved
+16 bit codes as the board produced them and, once closed, a JSON trailer
+with the gaps left by stream restarts and drops. A background thread does the
+writing, so the event loop only copies each block. The reader memory-maps
+the codes and converts to volts only the scans asked for.
+
+    stream = device.ad[0].stream(latency=.1, raw=True)
+    with Recorder('largo.daq', device.ad[0]) as recorder:
+        while recording:
+            time, codes = yield from stream.next()
+            recorder.write(time, codes)
+
+    recording = Recording('largo.daq')
+    volts = recording.volts(0, 1000, channel=0)
+
+Exportar a texto (tiempo y una columna por canal):
+
+    python daqrecorder.py largo.daq largo.txt
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DAQRAW01\n'
+# The header is rewritten in place on close with the scan count and the
+# offset of the trailer, which holds the gaps (any number of them)
+HEADER_SIZE = 4096
+CODE = np.dtype('<u2')
+
+
+def header(subsystem):
+    """Recording header of a configured ADSubsystem"""
+    conversion = subsystem.conversion
+    return dict(channels=[channel for channel, gain in subsystem.samples],
+                gains=[gain for channel, gain in subsystem.samples],
+                high=conversion['high'], low=conversion['low'],
+                resolution=conversion['resolution'],
+                offsetbinary=bool(conversion['offsetbinary']),
+                rate=conversion['rate'], start=time.time())
+
+
+def encode_header(values):
+    encoded = MAGIC + json.dumps(values).encode('utf-8') + b'\n'
+    if len(encoded) > HEADER_SIZE:
+        raise ValueError('Recording header too long: {} bytes'.format(
+            len(encoded)))
+    return encoded.ljust(HEADER_SIZE, b' ')
+
+
+def lookup_table(values, gain):
+    """Volts of every code, as ADSubsystem.lookup_table"""
+    resolution = values['resolution']
+    codes = np.arange(1 << 16, dtype=np.uint32)
+    codes &= (1 << resolution) - 1
+    if not values['offsetbinary']:
+        codes ^= 1 << (resolution - 1)
+    high, low = values['high'], values['low']
+    return (low + (high - low) / (1 << resolution) * codes) / gain
+
+
+class Recorder(object):
+    """Writes the raw blocks of an ADStream to filename
+
+    write only queues a block; when more than queue_size blocks are waiting
+    the new one is dropped and counted in dropped. high_water is the
+    largest number of blocks that were waiting. Scans missing between blocks
+    (stream restarts) are stored as gaps so the reader keeps time."""
+
+    def __init__(self, filename, subsystem, queue_size=64):
+        self.filename = filename
+        self.header = header(subsystem)
+        self.period = len(self.header['channels']) / self.header['rate']
+        self.scans = 0
+        self.next_scan = 0
+        self.gaps = []
+        self.written = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.error = None
+        self._fd = open(filename, 'wb')
+        self._fd.write(encode_header(self.header))
+        # Readable while recording, and after a crash
+        self._fd.flush()
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def write(self, times, codes):
+        """Queue a (scans, channels) block of codes starting at times[0]"""
+        if self.error is not None:
+            raise self.error
+        first = int(round(times[0] / self.period))
+        if first > self.next_scan:
+            self.gaps.append((self.scans, first - self.next_scan))
+        try:
+            self._queue.put_nowait(np.ascontiguousarray(codes, CODE))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Block dropped, %d waiting', self._queue.qsize())
+            # The reader sees the dropped block as a gap
+            self.next_scan = first
+            return
+        self.scans += len(codes)
+        self.next_scan = first + len(codes)
+        self.high_water = max(self.high_water, self._queue.qsize())
+
+    def _writer(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            try:
+                self._fd.write(block.data)
+            except Exception as e:
+                self.error = e
+                return
+            self.written += len(block)
+
+    def close(self):
+        """Write the waiting blocks, the trailer and the final header"""
+        try:
+            # If the writer died the queue may stay full
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            trailer = self._fd.tell()
+            gaps = [(scan, lost) for scan, lost in self.gaps
+                    if scan <= self.written]
+            self._fd.write(json.dumps(dict(gaps=gaps)).encode('utf-8'))
+            self.header.update(scans=self.written, trailer=trailer,
+                               dropped=self.dropped)
+            self._fd.seek(0)
+            self._fd.write(encode_header(self.header))
+        finally:
+            self._fd.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Recording(object):
+    """Read only view of a recording; codes is a (scans, channels) memory
+    map"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            head = fd.read(HEADER_SIZE)
+        if not head.startswith(MAGIC):
+            raise RuntimeError('Not a DAQ recording: {}'.format(filename))
+        self.header = json.loads(head[len(MAGIC):].decode('utf-8'))
+        self.channels = self.header['channels']
+        entries = len(self.channels)
+        self.period = entries / self.header['rate']
+        # Without a final header (recorder not closed) use what was written
+        available = (os.path.getsize(filename) - HEADER_SIZE) // \
+            (CODE.itemsize * entries)
+        scans = min(self.header.get('scans', available), available)
+        if scans:
+            self.codes = np.memmap(filename, dtype=CODE, mode='r',
+                                   offset=HEADER_SIZE,
+                                   shape=(scans, entries))
+        else:
+            self.codes = np.empty((0, entries), CODE)
+        self.tables = [lookup_table(self.header, gain)
+                       for gain in self.header['gains']]
+        gaps = []
+        if 'trailer' in self.header:
+            with open(filename, 'rb') as fd:
+                fd.seek(self.header['trailer'])
+                gaps = json.loads(fd.read().decode('utf-8'))['gaps']
+        self._gap_scans = np.array([scan for scan, lost in gaps], dtype=int)
+        self._gap_lost = np.cumsum([lost for scan, lost in gaps], dtype=int)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def time(self, start=0, stop=None):
+        """Seconds since the start of the recording of scans start:stop"""
+        scans = np.arange(*slice(start, stop).indices(len(self)))
+        lost = np.searchsorted(self._gap_scans, scans, side='right')
+        skipped = np.concatenate(([0], self._gap_lost))[lost]
+        return (scans + skipped) * self.period
+
+    def volts(self, start=0, stop=None, channel=None):
+        """Volts of scans start:stop, (scans, channels) or of a single
+        channel number"""
+        codes = self.codes[start:stop]
+        if channel is not None:
+            ii = self.channels.index(channel)
+            return self.tables[ii][codes[:, ii]]
+        ret = np.empty(codes.shape)
+        for ii, table in enumerate(self.tables):
+            np.take(table, codes[:, ii], out=ret[:, ii])
+        return ret
+
+    def blocks(self, scans):
+        """(time, volts) of consecutive blocks of scans"""
+        for start in range(0, len(self), scans):
+            yield self.time(start, start + scans), \
+                self.volts(start, start + scans)
+
+    def close(self):
+        self.codes = None
+
+
+def export_text(filename, output, scans=100000):
+    """Write time and the volts of each channel as text columns"""
+    recording = Recording(filename)
+    comments = 'Tiempo [s]\t' + '\t'.join('Canal {} [V]'.format(channel)
+                                         for channel in recording.channels)
+    with open(output, 'wb') as fd:
+        for ii, (times, volts) in enumerate(recording.blocks(scans)):
+            np.savetxt(fd, np.column_stack((times, volts)),
+                       header=comments if ii == 0 else '')
+    recording.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Exporta una adquisición '
+                                     'grabada a un archivo de texto')
+    parser.add_argument('archivo', help='Archivo de la adquisición')
+    parser.add_argument('salida', help='Archivo de texto')
+    args = parser.parse_args()
+    export_text(args.archivo, args.salida)
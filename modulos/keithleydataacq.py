@@ -3,12 +3,21 @@ import asyncio
 import ctypes
 from ctypes import wintypes
 import numpy as np
-import functools
-import queue
+import collections
+import math
+import threading
+import time
 
 def ctypes_pair(type):
     return (type, ctypes.POINTER(type))
 
+class DtError(Exception):
+    """Error code returned by a DT-Open Layers function"""
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
 class DtLib(object):
     class Types(object):
         wt = wintypes
@@ -242,9 +251,9 @@ class DtLib(object):
     }
     def ecodeCheck(self, ecode, function, args):
         if ecode != 0:
-            raise Exception('Calling {} with arguments {}: {} {}'.format(
+            raise DtError('Calling {} with arguments {}: {} {}'.format(
                 self.function_names[bytes(function)], args,
-                *DtLib.errorcodes[ecode]))
+                *DtLib.errorcodes[ecode]), ecode)
 
 class LibDacq(DtLib):
     class Encoding(object):
@@ -912,11 +921,216 @@ class Subsystem(lantz.Driver):
         dacq.lib.olDaGetSSCapsEx(self.handle, capability, ctypes.byref(ret))
         return ret.value
 
+class HandoffQueue(object):
+    """Bounded FIFO on preallocated slots, passing buffers from the driver's
+    notification thread to the event loop
+
+    depth is the number of buffers waiting, high_water the largest depth
+    seen and dropped the buffers refused because it was full."""
+
+    def __init__(self, capacity=0):
+        self.lock = threading.Lock()
+        self.slots = [None] * capacity
+        self.head = 0
+        self.depth = 0
+        self.high_water = 0
+        self.dropped = 0
+
+    @property
+    def capacity(self):
+        return len(self.slots)
+
+    def reserve(self, capacity):
+        """Grow to at least capacity slots, keeping the waiting buffers"""
+        with self.lock:
+            if capacity <= len(self.slots):
+                return
+            waiting = [self.slots[(self.head + ii) % len(self.slots)]
+                       for ii in range(self.depth)]
+            self.slots = waiting + [None] * (capacity - self.depth)
+            self.head = 0
+
+    def put(self, item):
+        """Append item, False if the queue is full"""
+        with self.lock:
+            if self.depth == len(self.slots):
+                self.dropped += 1
+                return False
+            self.slots[(self.head + self.depth) % len(self.slots)] = item
+            self.depth += 1
+            self.high_water = max(self.high_water, self.depth)
+            return True
+
+    def get(self):
+        """Oldest item, None if the queue is empty"""
+        with self.lock:
+            if not self.depth:
+                return None
+            item = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % len(self.slots)
+            self.depth -= 1
+            return item
+
+    def __len__(self):
+        return self.depth
+
+class BufferLease(object):
+    """Filled AD buffer lent by ADSubsystem.lease, handed back to the driver
+    by release or at the end of a with block
+
+    raw is a (scans, channels) view of the DMA memory, in channel list
+    order; it must not be used after release."""
+
+    def __init__(self, subsystem, buf, raw):
+        self.subsystem = subsystem
+        self.buf = buf
+        self.raw = raw
+
+    @property
+    def time(self):
+        return self.subsystem.times(len(self.raw))
+
+    def volts(self, out=None):
+        """Converted (scans, channels) array, see ADSubsystem.convert"""
+        return self.subsystem.convert(self.raw, out)
+
+    def release(self):
+        if self.buf is not None:
+            dacq.lib.olDaPutBuffer(self.subsystem.handle, self.buf)
+            self.buf = None
+            self.raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class ADStream(object):
+    """Continuous acquisition handed out as blocks of a fixed number of scans
+
+        stream = device.ad[0].stream(latency=.1)
+        while True:
+            time, volts = yield from stream.next()
+
+    or, with Python 3.5, async for time, volts in stream. Blocks are like
+    read_matrix, with time counted from the start of the stream. Each DMA
+    buffer goes back to the driver as soon as it is converted. With raw the
+    blocks hold a copy of the codes instead of volts, for daqrecorder.
+
+    The ring has one buffer per latency seconds of slack, the time the
+    consumer may fall behind. If the driver runs out of buffers it stops;
+    the stream then restarts it, counting restarts and an estimate of the
+    scans lost meanwhile (time keeps counting across the gap). stalls counts
+    blocks after which the driver had no more than one buffer left to fill,
+    and backlog is the number of filled buffers waiting in the hand-off
+    queue."""
+
+    MIN_BUFFERS = 3
+
+    def __init__(self, subsystem, latency, slack, raw=False):
+        entries = len(subsystem.samples)
+        rate = subsystem.conversion['rate']
+        self.subsystem = subsystem
+        self.raw = raw
+        self.period = entries / rate
+        self.scans = max(1, int(round(latency / self.period)))
+        self.number = max(self.MIN_BUFFERS,
+                          int(math.ceil(slack / latency)) + 1)
+        subsystem.prepareBuffers(self.number, self.scans * entries)
+        self.blocks = 0
+        self.scan = 0
+        self.restarts = 0
+        self.lost_scans = 0
+        self.stalls = 0
+        self.backlog = 0
+        self.stopped_at = None
+        self.waiter = None
+        self.closed = False
+
+    @property
+    def overruns(self):
+        return self.subsystem.events[Subsystem.Messages.OVERRUN_ERROR]
+
+    def notify(self, message):
+        """Called in the event loop for every driver message"""
+        if message in (Subsystem.Messages.OVERRUN_ERROR,
+                       Subsystem.Messages.QUEUE_DONE,
+                       Subsystem.Messages.QUEUE_STOPPED) and \
+                self.stopped_at is None:
+            self.stopped_at = time.time()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(message)
+
+    @asyncio.coroutine
+    def next(self):
+        """Next (time, volts) block, None once the stream is closed"""
+        while not self.closed:
+            lease = self.subsystem.lease()
+            if lease is not None:
+                return self.block(lease)
+            if self.stopped_at is not None:
+                # Every filled buffer was read, all of them are ready again
+                self.restart()
+                continue
+            self.waiter = asyncio.Future()
+            yield from self.waiter
+            self.waiter = None
+        return None
+
+    def block(self, lease):
+        with lease:
+            volts = lease.raw.copy() if self.raw else lease.volts()
+        times = self.period * (self.scan + np.arange(len(volts)))
+        self.scan += len(volts)
+        self.blocks += 1
+        ready = self.subsystem.queue_size(Subsystem.QUE_READY)
+        self.backlog = len(self.subsystem.handoff)
+        if ready <= 1 and self.stopped_at is None:
+            self.stalls += 1
+        return times, volts
+
+    def restart(self):
+        lost = int(round((time.time() - self.stopped_at) / self.period))
+        self.lost_scans += lost
+        self.scan += lost
+        self.restarts += 1
+        self.stopped_at = None
+        self.subsystem.halt()
+        self.subsystem.start()
+
+    def close(self):
+        self.closed = True
+        if self.subsystem.current_stream is self:
+            self.subsystem.current_stream = None
+        self.subsystem.halt()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        ret = yield from self.next()
+        if ret is None:
+            raise StopAsyncIteration()
+        return ret
+
 class ADSubsystem(Subsystem):
     def __init__(self, device, index):
         super().__init__(device, Subsystem.Types.AD, index)
         self.buffers = 0
-        self.futures = queue.Queue()
+        # Filled buffers taken from the driver by callback
+        self.handoff = HandoffQueue()
+        # (future, reader) of coroutines waiting for a buffer
+        self.futures = collections.deque()
+        # Driver messages received, by message code
+        self.events = collections.Counter()
+        self.current_stream = None
+        # QUEUE_STOPPED messages still to come from our own halt calls
+        self.expected_stops = 0
         self.loop = asyncio.get_event_loop()
         # Prevent garbage collection of callback pointer
         self.cb = DtLib.Types.OLNOTIFYPROC(ADSubsystem.callback)
@@ -926,20 +1140,58 @@ class ADSubsystem(Subsystem):
     def close(self):
         super().close()
         #dacq.lib.olDaFlushBuffers(self.handle)
+        buf = self.handoff.get()
+        while buf is not None:
+            mem.lib.olDmFreeBuffer(buf)
+            self.buffers -= 1
+            buf = self.handoff.get()
         buf = DtLib.Types.HBUF()
         for ii in range(self.buffers):
             dacq.lib.olDaGetBuffer(self.handle, ctypes.byref(buf))
             mem.lib.olDmFreeBuffer(buf)
 
+    # Converted buffers returned by read are reused, each stays valid until
+    # this many more reads
+    OUTPUT_BUFFERS = 2
+
     @lantz.Action()
     def configure(self, samples):
+        """Set the channel list, a list of (channel, gain), and capture the
+        conversion parameters used by read"""
         self.samples = samples
         dacq.lib.olDaSetChannelListSize(self.handle, len(samples))
         for ii, (channel, gain) in enumerate(samples):
             dacq.lib.olDaSetChannelListEntry(self.handle, ii, channel)
             dacq.lib.olDaSetGainListEntry(self.handle, ii, gain)
         super().configure()
+        self.capture_conversion()
 
+    def capture_conversion(self):
+        """Read range, resolution, encoding and sample rate once and build
+        a code to voltage lookup table for each gain in use"""
+        high, low = self.range
+        self.conversion = dict(high=high, low=low,
+                               resolution=self.resolution,
+                               offsetbinary=self.offsetbinary_encoding,
+                               rate=self.sampleRate.to('Hz').magnitude)
+        self.tables = {gain: self.lookup_table(gain)
+                       for channel, gain in getattr(self, 'samples', [])}
+        self.tables.setdefault(1, self.lookup_table(1))
+        self._outputs = []
+        self._next_output = 0
+        self._time = None
+
+    def lookup_table(self, gain):
+        """Voltage at the input for every 16 bit word read with gain"""
+        conversion = self.conversion
+        resolution = conversion['resolution']
+        codes = np.arange(1 << 16, dtype=np.uint32)
+        codes &= (1 << resolution) - 1
+        if not conversion['offsetbinary']:
+            # Two's complement: flipping the sign bit gives offset binary
+            codes ^= 1 << (resolution - 1)
+        high, low = conversion['high'], conversion['low']
+        return (low + (high - low) / (1 << resolution) * codes) / gain
 
     @lantz.DictFeat(units='V')
     def readOne(self, channel):
@@ -947,7 +1199,7 @@ class ADSubsystem(Subsystem):
         reading = ctypes.c_long()
         dacq.lib.olDaGetSingleValue(self.handle, ctypes.byref(reading), channel,
                 gain)
-        return self.codeToVoltage(reading)[0]
+        return self.codeToVoltage(reading.value)[0]
 
 
     def prepareBuffers(self, number, size):
@@ -956,63 +1208,169 @@ class ADSubsystem(Subsystem):
             mem.lib.olDmCallocBuffer(0, 0, size, 2, ctypes.byref(buf))
             dacq.lib.olDaPutBuffer(self.handle, buf)
         self.buffers += number
+        self.handoff.reserve(self.buffers)
+
+    def halt(self):
+        """Stop acquisition, expecting the QUEUE_STOPPED message that
+        follows. Returns False if the driver refused (already stopped)"""
+        try:
+            self.stop()
+        except DtError:
+            return False
+        self.expected_stops += 1
+        return True
+
+    def queue_size(self, queue):
+        """Buffers in queue (QUE_READY, QUE_DONE or QUE_INPROCESS)"""
+        ret = wintypes.UINT()
+        dacq.lib.olDaGetQueueSize(self.handle, queue, ctypes.byref(ret))
+        return ret.value
+
+    def stream(self, latency=.1, slack=1., raw=False):
+        """Start continuous acquisition, returning an ADStream of blocks of
+        about latency seconds; buffers for slack seconds are allocated"""
+        if self.current_stream is not None:
+            self.current_stream.close()
+        self.current_stream = ADStream(self, latency, slack, raw)
+        self.start()
+        return self.current_stream
 
     @asyncio.coroutine
-    def read_async(self):
-        ret = self.read()
+    def wait_for(self, reader):
+        """Result of reader, waiting for a filled buffer if there is none"""
+        ret = reader()
         if not ret:
             # Wait for data
             future = asyncio.Future()
-            self.futures.put(future)
+            self.futures.append((future, reader))
             ret = yield from future
         return ret
 
+    @asyncio.coroutine
+    def read_async(self):
+        return (yield from self.wait_for(self.read))
+
+    @asyncio.coroutine
+    def read_matrix_async(self):
+        return (yield from self.wait_for(self.read_matrix))
+
+    @asyncio.coroutine
+    def lease_async(self):
+        return (yield from self.wait_for(self.lease))
+
     def read_blocking(self):
         return self.loop.run_until_complete(self.read_async())
 
     @staticmethod
     def callback(message, subsystem, param):
+        """Runs on the driver's notification thread: moves filled buffers to
+        the hand-off queue and leaves everything else to dispatch"""
         self = ctypes.cast(ctypes.c_void_p(param), ctypes.py_object).value
+        self.events[message] += 1
         if message == Subsystem.Messages.BUFFER_DONE:
-            try:
-                future = self.futures.get(False)
-            except queue.Empty:
-                return
-            self.loop.call_soon_threadsafe(functools.partial(
-                future.set_result, self.read()))
+            while True:
+                buf = DtLib.Types.HBUF()
+                dacq.lib.olDaGetBuffer(self.handle, ctypes.byref(buf))
+                if buf.value is None:
+                    break
+                if not self.handoff.put(buf):
+                    # Cannot happen with capacity for every buffer; do not
+                    # starve the driver anyway
+                    dacq.lib.olDaPutBuffer(self.handle, buf)
+        self.loop.call_soon_threadsafe(self.dispatch, message)
+
+    def dispatch(self, message):
+        """Event loop side of callback: wakes the stream or the coroutines
+        waiting for buffers, which are converted here"""
+        if message == Subsystem.Messages.QUEUE_STOPPED and \
+                self.expected_stops:
+            # Not a stall, we stopped it
+            self.expected_stops -= 1
+        elif self.current_stream is not None:
+            self.current_stream.notify(message)
+        while self.futures and self.handoff.depth:
+            future, reader = self.futures.popleft()
+            if not future.done():
+                future.set_result(reader())
+
+    def output(self, shape):
+        """Next reusable array for converted samples"""
+        if len(self._outputs) < self.OUTPUT_BUFFERS:
+            self._outputs.append(np.empty(shape))
+        elif self._outputs[self._next_output].shape != shape:
+            self._outputs[self._next_output] = np.empty(shape)
+        ret = self._outputs[self._next_output]
+        self._next_output = (self._next_output + 1) % self.OUTPUT_BUFFERS
+        return ret
 
-    def read(self):
-        buf = DtLib.Types.HBUF()
-        dacq.lib.olDaGetBuffer(self.handle, ctypes.byref(buf))
-        if buf.value is None:
-            return dict()
+    def times(self, scans):
+        """Time of each scan, shared between reads (read only)"""
+        if self._time is None or len(self._time) != scans:
+            self._time = np.arange(scans) * len(self.samples) / \
+                    self.conversion['rate']
+            self._time.setflags(write=False)
+        return self._time
+
+    def lease(self):
+        """BufferLease of the oldest filled buffer, None if there is none"""
+        buf = self.handoff.get()
+        if buf is None:
+            return None
         numsamples = wintypes.DWORD()
         mem.lib.olDmGetMaxSamples(buf, ctypes.byref(numsamples))
         data = wintypes.LPWORD()
         mem.lib.olDmGetBufferPtr(buf, ctypes.cast(ctypes.byref(data),
             ctypes.POINTER(ctypes.c_voidp)))
         raw = np.ctypeslib.as_array(data, (numsamples.value, ))
-        voltages = self.codeToVoltage(raw)
-        channels = {channel: voltages[ii::len(self.samples)]*gain
+        entries = len(self.samples)
+        scans = numsamples.value // entries
+        return BufferLease(self, buf,
+                raw[:scans * entries].reshape(scans, entries))
+
+    def convert(self, raw, out=None):
+        """Volts of a (scans, channels) array of codes, written to out or
+        to the next reusable array (see OUTPUT_BUFFERS)"""
+        if out is None:
+            out = self.output(raw.shape)
+        gains = set(gain for channel, gain in self.samples)
+        if len(gains) == 1:
+            np.take(self.tables[gains.pop()], raw, out=out, mode='clip')
+        else:
+            for ii, (channel, gain) in enumerate(self.samples):
+                np.take(self.tables[gain], raw[:, ii], out=out[:, ii],
+                        mode='clip')
+        return out
+
+    def read_matrix(self):
+        """(time, volts) of the next filled buffer, None if there is none.
+        volts is (scans, channels) in channel list order and is reused, see
+        OUTPUT_BUFFERS"""
+        lease = self.lease()
+        if lease is None:
+            return None
+        with lease:
+            return lease.time, lease.volts()
+
+    def read(self):
+        """Dictionary of channel: volts and 'time': seconds of the next
+        filled buffer, empty if there is none. The channels are columns of
+        read_matrix, without copies"""
+        ret = self.read_matrix()
+        if ret is None:
+            return dict()
+        seconds, voltages = ret
+        channels = {channel: voltages[:, ii]
                 for ii, (channel, gain) in enumerate(self.samples)}
-        dacq.lib.olDaPutBuffer(self.handle, buf)
-        channels['time'] = np.arange(numsamples.value / len(self.samples)) * \
-                len(self.samples) / self.sampleRate.to('Hz').magnitude
+        channels['time'] = seconds
         return channels
 
-    def codeToVoltage(self, code):
-        if isinstance(code, int):
-            code = np.array([code])
-        else:
-            code = np.array(code)
-        high, low = self.range
-        resolution = self.resolution
-        if not self.offsetbinary_encoding:
-            ret = code.astype(np.uint) + 1 << (resolution - 1)
-        else:
-            ret = code.copy()
-        ret = low + (high - low) / (1 << resolution) * ret
-        return ret
+    def codeToVoltage(self, code, gain=1):
+        if not hasattr(self, 'conversion'):
+            self.capture_conversion()
+        if gain not in self.tables:
+            self.tables[gain] = self.lookup_table(gain)
+        return self.tables[gain][np.atleast_1d(code).astype(np.uint32) &
+                                 0xffff]
 
 class WriteableSubsystem(Subsystem):
     @lantz.Action()
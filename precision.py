@@ -0,0 +1,146 @@
+"""Average just enough readings to reach a relative precision
+
+    averager = PrecisionAverager(lcr, precision=1e-3, max_averages=10)
+    averager.calibrate(lambda: lcr.measure)
+    for bias in biases:
+        ...
+        result = averager.measure(lambda: lcr.measure)
+
+The driver needs a speed Feat and a speeds list with its settings from the
+fastest to the slowest. Calibration measures the noise and the time per
+reading at every speed for the present frequency, drive level and bias.
+"""
+import asyncio
+import math
+from collections import namedtuple
+from time import time
+
+import numpy as np
+
+
+class SpeedProfile(namedtuple('SpeedProfile', 'speed noise time')):
+    """noise is the relative standard deviation of one reading, time the
+    seconds per reading"""
+
+
+class PrecisionResult(namedtuple('PrecisionResult',
+                                 'value reads speed error precise')):
+    """value is the mean of reads readings taken at speed, error the relative
+    standard error of the mean of the checked components"""
+
+
+class PrecisionAverager(object):
+    """Pick speed and number of averages for each point
+
+    Every point starts at the speed that reaches precision with the least
+    calibrated measuring time. Readings are added until the standard error of
+    the mean, relative to the mean, is within precision for the checked
+    components (the first one, C or L, by default). If max_averages readings
+    are not enough, the point is measured again at the next slower speed.
+
+    Below min_spread readings the standard deviation comes from the
+    calibration instead of from the point itself."""
+
+    def __init__(self, driver, precision, max_averages=10, components=(0,),
+                 min_spread=3):
+        if max_averages < 1:
+            raise ValueError('Need at least one reading per point')
+        self.driver = driver
+        self.precision = precision
+        self.max_averages = max_averages
+        self.components = list(components)
+        self.min_spread = min_spread
+        self.profiles = None
+
+    def averages(self, profile):
+        """Readings needed at profile according to the calibration
+
+        A calibration with a null mean has no relative noise; then use up to
+        max_averages"""
+        if not math.isfinite(profile.noise):
+            return self.max_averages
+        return max(1, math.ceil((profile.noise / self.precision) ** 2))
+
+    def plan(self):
+        """Profiles to try for each point, the cheapest first"""
+        feasible = [profile for profile in self.profiles
+                    if self.averages(profile) <= self.max_averages]
+        if not feasible:
+            return self.profiles[-1:]
+        best = min(feasible,
+                   key=lambda profile: self.averages(profile) * profile.time)
+        return self.profiles[self.profiles.index(best):]
+
+    def _calibrated(self, speed, readings, elapsed):
+        data = np.array(readings, dtype=float)[:, self.components]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            noise = np.max(data.std(axis=0, ddof=1) /
+                           np.abs(data.mean(axis=0)))
+        return SpeedProfile(speed, float(noise), elapsed / len(readings))
+
+    def calibrate(self, read, reads=5):
+        """Time reads readings at every speed, after one discarded reading"""
+        self.profiles = []
+        for speed in self.driver.speeds:
+            self.driver.speed = speed
+            read()
+            start = time()
+            readings = [read() for ii in range(reads)]
+            self.profiles.append(self._calibrated(speed, readings,
+                                                  time() - start))
+        return self.profiles
+
+    @asyncio.coroutine
+    def calibrate_async(self, read, reads=5):
+        """Like calibrate, with read a coroutine function"""
+        self.profiles = []
+        for speed in self.driver.speeds:
+            yield from self.driver.update_async(speed=speed)
+            yield from read()
+            start = time()
+            readings = []
+            for ii in range(reads):
+                readings.append((yield from read()))
+            self.profiles.append(self._calibrated(speed, readings,
+                                                  time() - start))
+        return self.profiles
+
+    def error(self, readings, profile):
+        data = np.array(readings, dtype=float)[:, self.components]
+        mean = np.abs(data.mean(axis=0))
+        if len(readings) < self.min_spread:
+            spread = profile.noise * mean
+        else:
+            spread = data.std(axis=0, ddof=1)
+        return float(np.max(spread / math.sqrt(len(readings)) / mean))
+
+    def result(self, readings, profile):
+        error = self.error(readings, profile)
+        return PrecisionResult(tuple(np.mean(readings, axis=0)),
+                               len(readings), profile.speed, error,
+                               error <= self.precision)
+
+    def measure(self, read):
+        """Average read() readings until precise, see the class docstring"""
+        for profile in self.plan():
+            self.driver.speed = profile.speed
+            readings = []
+            while len(readings) < self.max_averages:
+                readings.append(read())
+                result = self.result(readings, profile)
+                if result.precise:
+                    return result
+        return result
+
+    @asyncio.coroutine
+    def measure_async(self, read):
+        """Like measure, with read a coroutine function"""
+        for profile in self.plan():
+            yield from self.driver.update_async(speed=profile.speed)
+            readings = []
+            while len(readings) < self.max_averages:
+                readings.append((yield from read()))
+                result = self.result(readings, profile)
+                if result.precise:
+                    return result
+        return result
@@ -0,0 +1,84 @@
+"""Render waveform preview PNGs in worker processes
+
+    previews = PreviewRenderer(size=(9, 4.5), dpi=60)
+    previews.submit('000_1.00e-03 s_0.png', waveforms)
+    ...
+    previews.close()
+
+submit never waits: when max_pending previews are already queued the new
+one is dropped and counted in dropped.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def render(filename, traces, size, dpi):
+    """Save one subplot per channel of traces (channel: (time, volts))"""
+    # Agg canvas without pyplot: no GUI backend or global state in workers
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=size)
+    FigureCanvasAgg(figure)
+    channels = sorted(traces)
+    for ii, channel in enumerate(channels):
+        axes = figure.add_subplot(1, len(channels), ii + 1)
+        axes.plot(*traces[channel])
+        axes.set_xlabel('Tiempo [s]')
+        axes.set_ylabel('Tensión [V]')
+    figure.savefig(filename, dpi=dpi)
+    return filename
+
+
+class PreviewRenderer(object):
+    """Queue of previews rendered by a process pool
+
+    Waveforms are decimated to about two samples per horizontal pixel
+    before being sent to the workers."""
+
+    def __init__(self, size=(18, 9), dpi=100, workers=1, max_pending=4):
+        self.size = size
+        self.dpi = dpi
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.futures = []
+        self.executor = ProcessPoolExecutor(workers)
+
+    def traces(self, waveforms):
+        """Decimated (time, volts) of each channel, as plain arrays"""
+        pixels = self.size[0] * self.dpi / len(waveforms)
+        ret = dict()
+        for channel, waveform in waveforms.items():
+            step = max(1, int(len(waveform) / (2 * pixels)))
+            waveform = waveform[::step]
+            ret[channel] = (waveform.time, waveform.volts)
+        return ret
+
+    @property
+    def pending(self):
+        self.futures = [future for future in self.futures
+                        if not future.done()]
+        return len(self.futures)
+
+    def submit(self, filename, waveforms):
+        """Queue a preview, return False if it was dropped"""
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            logger.debug('Preview %s dropped, %d pending', filename,
+                         len(self.futures))
+            return False
+        future = self.executor.submit(render, filename,
+                                      self.traces(waveforms), self.size,
+                                      self.dpi)
+        future.add_done_callback(self._done)
+        self.futures.append(future)
+        return True
+
+    def _done(self, future):
+        if future.exception() is not None:
+            logger.error('Preview failed: %s', future.exception())
+
+    def close(self, wait=False):
+        """Stop accepting previews; queued ones are still rendered"""
+        self.executor.shutdown(wait)
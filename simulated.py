@@ -0,0 +1,842 @@
+"""Simulated instrument sessions
+
+Each simulator stands in for the VISA resource (or serial port) behind one of
+our drivers and answers the same command strings the real instrument does, so
+sweeps can be run and profiled away from the lab bench.
+
+    from simulated import Keithley617Simulator, attach
+    inst = Keithley617('GPIB0::28::INSTR')
+    attach(inst, Keithley617Simulator(latency={'X$': .01}))
+    inst.initialize()
+
+install() does the same for every driver created afterwards, looking the
+session up by resource name (or serial port), so unmodified scripts can run
+against a simulated bench.
+
+Every session counts bus transactions and the time spent in them.
+"""
+from collections import Counter, deque
+from time import sleep as _sleep, time
+import math
+import random
+import re
+import struct
+import threading
+
+import numpy as np
+import pyvisa.constants as vi
+from pyvisa.errors import VisaIOError
+from lantz.visa import MessageVisaDriver
+from lantz.serial import SerialDriver
+
+
+def _timeout():
+    """What VISA raises when the instrument does not answer in time"""
+    return VisaIOError(vi.VI_ERROR_TMO)
+
+
+class _VisaLibrary(object):
+    """The part of resource.visalib the drivers use"""
+
+    def read(self, session, count):
+        """Up to count bytes of the pending message, as viRead"""
+        return session._read(count), vi.StatusCode.success
+
+
+class Session(object):
+    """Message based session with configurable per-command latency
+
+    latency maps regular expressions to the time in seconds that a command
+    matching them takes to execute. Other commands take default_latency.
+    read_latency is added to every message read back."""
+
+    TERMINATION = '\r\n'
+
+    def __init__(self, latency=None, default_latency=0., read_latency=0.):
+        self.latency = [(re.compile(pattern), delay)
+                        for pattern, delay in (latency or {}).items()]
+        self.default_latency = default_latency
+        self.read_latency = read_latency
+        self.output = deque()
+        self.lock = threading.RLock()
+        self.events = set()
+        self.visalib = _VisaLibrary()
+        # resource.session, the handle given to visalib
+        self.session = self
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.io_time = 0.
+        self.counts = Counter()
+
+    def _account(self, kind, start):
+        self.transactions += 1
+        self.counts[kind] += 1
+        self.io_time += time() - start
+
+    def command_latency(self, command):
+        for pattern, delay in self.latency:
+            if pattern.search(command):
+                return delay
+        return self.default_latency
+
+    def reply(self, message):
+        """Queue a message for the controller to read"""
+        if isinstance(message, str):
+            message = (message + self.TERMINATION).encode('ascii')
+        self.output.append(message)
+
+    def talk(self):
+        """Message sent when addressed to talk with nothing queued"""
+        raise _timeout()
+
+    def command(self, command):
+        """Interpret a message from the controller"""
+        raise NotImplementedError()
+
+    def status_byte(self):
+        return 0
+
+    def trigger(self):
+        """Group Execute Trigger"""
+
+    def _write(self, data):
+        start = time()
+        command = data.decode('ascii').strip('\r\n')
+        with self.lock:
+            self.command(command)
+        _sleep(self.command_latency(command))
+        self._account(command[:4], start)
+        return len(data)
+
+    def _read(self, size=None):
+        start = time()
+        with self.lock:
+            if not self.output:
+                self.talk()
+            message = self.output.popleft()
+            if size is not None and 0 < size < len(message):
+                self.output.appendleft(message[size:])
+                return message[:size]
+        _sleep(self.read_latency)
+        self._account('read', start)
+        return message
+
+    # VISA resource interface
+    def write_raw(self, message):
+        return self._write(message)
+
+    def read_raw(self, size=None):
+        # Like pyvisa, size is only a chunk size: the whole message is read
+        return self._read()
+
+    def read_stb(self):
+        start = time()
+        with self.lock:
+            ret = self.status_byte()
+        self._account('stb', start)
+        return ret
+
+    def assert_trigger(self):
+        start = time()
+        with self.lock:
+            self.trigger()
+        self._account('trigger', start)
+
+    def clear(self):
+        self.output.clear()
+
+    def set_visa_attribute(self, attribute, value):
+        pass
+
+    def enable_event(self, event_type, mechanism, context=None):
+        self.events.add(event_type)
+
+    def disable_event(self, event_type, mechanism):
+        self.events.discard(event_type)
+
+    def close(self):
+        pass
+
+    # pyserial interface
+    def open(self):
+        pass
+
+    def isOpen(self):
+        return True
+
+    def write(self, data):
+        return self._write(data)
+
+    def read(self, size=1):
+        if not self.output:
+            return b''
+        return self._read(size)
+
+    def inWaiting(self):
+        return sum(len(message) for message in self.output)
+
+    def flushInput(self):
+        self.output.clear()
+
+    def flushOutput(self):
+        pass
+
+
+def _number(text, default=0.):
+    return float(text) if text else default
+
+keithley_command_re = re.compile(r'([A-Z])([+\-]?[0-9.]*(?:E[+\-]?[0-9]+)?)')
+
+class KeithleySession(Session):
+    """Keithley DDC protocol: letter commands executed on X"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = []
+
+    def command(self, command):
+        if command == 'DCL':
+            self.clear()
+            return
+        for letter, argument in keithley_command_re.findall(command):
+            if letter == 'X':
+                pending, self.pending = self.pending, []
+                for item in pending:
+                    self.execute(*item)
+                self.executed()
+            else:
+                self.pending.append((letter, argument))
+
+    def execute(self, letter, argument):
+        raise NotImplementedError()
+
+    def executed(self):
+        """Called after a batch of commands is executed by X"""
+
+
+def diode(current, saturation=1e-12, ideality=1.5, series=50.,
+          temperature=300.):
+    """Voltage across a diode with series resistance"""
+    thermal = 8.617e-5 * temperature
+    return (2 * ideality * thermal * math.asinh(current / (2 * saturation)) +
+            series * current)
+
+
+class Keithley617Simulator(KeithleySession):
+    """Keithley 617 electrometer
+
+    reading(function) returns the value measured by the given function code
+    (0 volts, 1 amps, 2 ohms, 3 coulombs). Readings get relative gaussian
+    noise."""
+
+    prefixes = ['DCV', 'DCA', 'OHM', 'COU']
+
+    def __init__(self, reading=None, noise=1e-4, **kwargs):
+        kwargs.setdefault('read_latency', .003)
+        super().__init__(**kwargs)
+        self.reading = reading or (lambda function: 0.)
+        self.noise = noise
+        self.settings = dict(F=0, R=0, C=1, Z=0, N=0, T=6, K=0, B=0, G=0, D=0,
+                             M=0, Y=0)
+
+    def execute(self, letter, argument):
+        if letter == 'U':
+            self.reply(self.status())
+        elif letter in self.settings:
+            self.settings[letter] = int(_number(argument))
+
+    def status(self):
+        return '617{F}{R:02d}{C}{Z}{N}{T}{K}{B}{G}{D}{M:02d}{Y}'.format(
+            **self.settings)
+
+    def talk(self):
+        function = self.settings['F']
+        if self.settings['C']:
+            value = 0.
+        else:
+            value = self.reading(function)
+            value += abs(value) * random.gauss(0, self.noise)
+        prefix = ''
+        if self.settings['G'] == 0:
+            prefix = 'N' + self.prefixes[function]
+        self.reply('{}{:+.4E}'.format(prefix, value))
+
+
+class Keithley220Simulator(KeithleySession):
+    """Keithley 220 programmable current source with its 100 location
+    program memory"""
+
+    locations = 100
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Current, voltage limit and dwell time of each memory location
+        self.memory = [[0., 1., 3e-3] for ii in range(self.locations + 1)]
+        self.settings = dict(F=0, G=0, T=6, K=0, M=0, P=0, R=0, Y=0)
+        self.address = 1
+        self.display_address = 1
+        self.pointer = 1
+        self.started = None
+
+    def execute(self, letter, argument):
+        if letter == 'U':
+            self.reply(self.status())
+        elif letter in 'IVW':
+            self.memory[self.address]['IVW'.index(letter)] = _number(argument)
+        elif letter == 'B':
+            self.address = int(_number(argument, 1))
+            self.pointer = self.address
+        elif letter == 'L':
+            self.display_address = int(_number(argument, 1))
+        elif letter in self.settings:
+            self.settings[letter] = int(_number(argument))
+            if letter == 'P':
+                self.started = None
+                self.pointer = 1
+
+    def status(self):
+        return '{G}{F}{T}{K}{M}{P}{R}{Y}'.format(**self.settings)
+
+    def trigger(self):
+        program = self.settings['P']
+        if program == 2:
+            # Step: every trigger advances one location
+            self.pointer = self.pointer % self.locations + 1
+        elif program == 1:
+            # Continuous: run on the dwell timer from location 1
+            self.started = time()
+            self.pointer = 1
+
+    def location(self):
+        """Memory location currently sourced"""
+        if self.settings['P'] == 1 and self.started is not None:
+            elapsed = time() - self.started
+            pointer = 1
+            while elapsed > self.memory[pointer][2] > 0:
+                elapsed -= self.memory[pointer][2]
+                pointer = pointer % self.locations + 1
+            return pointer
+        elif self.settings['P'] == 2:
+            return self.pointer
+        return self.address
+
+    @property
+    def current(self):
+        """Current flowing out of the source"""
+        if not self.settings['F']:
+            return 0.
+        return self.memory[self.location()][0]
+
+    def talk(self):
+        address = self.address
+        if self.settings['G'] in (1, 2):
+            address = self.display_address
+        current, limit, dwell = self.memory[address]
+        fields = ['{:+.4E}'.format(current), '{:+.2E}'.format(limit),
+                  '{:+.3E}'.format(dwell)]
+        if self.settings['G'] in (0, 1):
+            fields = [prefix + field for prefix, field in
+                      zip(['NDCI', 'V', 'W'], fields)]
+        fields.append('{:03d}'.format(address))
+        self.reply(','.join(fields))
+
+
+class Keithley705Simulator(KeithleySession):
+    """Keithley 705 scanner in matrix mode"""
+
+    columns = range(1, 6)
+    rows = range(1, 5)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.closed = set()
+        self.pointer = (1, 1)
+        self.settings = dict(A=0, G=0)
+
+    def execute(self, letter, argument):
+        if letter in 'CN':
+            key = (int(argument[-2]), int(argument[-1]))
+            if letter == 'C':
+                self.closed.add(key)
+            else:
+                self.closed.discard(key)
+        elif letter == 'B':
+            self.pointer = (int(argument[:-1]), int(argument[-1]))
+        elif letter == 'R':
+            self.closed.clear()
+        elif letter == 'U':
+            self.reply(self.status(int(_number(argument))))
+        elif letter in self.settings:
+            self.settings[letter] = int(_number(argument))
+
+    def status(self, kind):
+        if kind == 1:
+            return ','.join('{}:{},{:d}'.format(col, row,
+                                                (col, row) in self.closed)
+                            for col in self.columns for row in self.rows)
+        elif kind == 4:
+            return 'A{A}G{G}'.format(**self.settings)
+        return '705{:02d}{:d}{:d}'.format(self.pointer[0], self.pointer[1],
+                                          self.pointer in self.closed)
+
+
+def mos_capacitor(bias, frequency, cox=100e-12, cmin=20e-12, flatband=-.5,
+                  width=.3, conductance=1e-7):
+    """Parallel capacitance and conductance of a MOS capacitor"""
+    x = min(max((bias - flatband) / width, -50), 50)
+    return (cmin + (cox - cmin) / (1 + math.exp(x)), conductance)
+
+
+class HP4277ASimulator(Session):
+    """HP 4277A LCZ meter, also used as bias source
+
+    reading(bias, frequency) returns the parallel capacitance and
+    conductance of the device under test. Measurement time and relative
+    noise depend on the speed setting."""
+
+    TERMINATION = '\r\n'
+    measure_time = {'1': .2, '2': .06, '3': .025}
+    measure_noise = {'1': 1e-4, '2': 3e-4, '3': 1e-3}
+    token_re = re.compile(r'(FR)([0-9.]+)EN|(BI)([+\-0-9.]+)EN|(EX|LN)|'
+                          r'([A-Z])([0-9])')
+
+    def __init__(self, reading=mos_capacitor, **kwargs):
+        super().__init__(**kwargs)
+        self.reading = reading
+        self.frequency = 10.
+        self.bias = 0.
+        self.settings = dict(A='1', B='3', C='1', D='0', F='1', M='2', P='0',
+                             R='4', S='0', T='1', U='1', V='1', X='0')
+        self.ready_at = None
+        self.result = None
+
+    def learn(self):
+        return 'FR{:.1f}EN{}BI{:+.2f}EN'.format(self.frequency, ''.join(
+            key + self.settings[key] for key in 'ABCDFMPRSTUVX'), self.bias)
+
+    def command(self, command):
+        for match in self.token_re.finditer(command):
+            groups = match.groups()
+            if groups[0]:
+                self.frequency = float(groups[1])
+            elif groups[2]:
+                self.bias = float(groups[3])
+            elif groups[4] == 'LN':
+                self.reply(self.learn())
+            elif groups[4] == 'EX':
+                self.start_measurement()
+            elif groups[5] in self.settings:
+                self.settings[groups[5]] = groups[6]
+
+    def start_measurement(self):
+        speed = self.settings['M']
+        c, g = self.reading(self.bias, self.frequency * 1e3)
+        noise = self.measure_noise[speed]
+        c *= 1 + random.gauss(0, noise)
+        g *= 1 + random.gauss(0, noise)
+        w = 2 * math.pi * self.frequency * 1e3
+        function_a = self.settings['A']
+        if function_a in '24':
+            letter_a, value_a = 'C', c
+        elif function_a in '13':
+            letter_a, value_a = 'L', 1 / (w * w * c)
+        else:
+            letter_a, value_a = 'Z', 1 / abs(complex(g, w * c))
+        letter_b, value_b = {'1': ('D', g / (w * c)), '2': ('Q', w * c / g),
+                             '3': ('R', g / (g * g + w * w * c * c))}[
+                                 self.settings['B']]
+        circuit = 'S' if self.settings['C'] == '2' else 'P'
+        self.result = '{}N{}{:+.4E},N{}{:+.4E}'.format(
+            circuit, letter_a, value_a, letter_b, value_b)
+        self.ready_at = time() + self.measure_time[speed]
+
+    def data_ready(self):
+        return self.ready_at is not None and time() >= self.ready_at
+
+    def status_byte(self):
+        return int(self.data_ready())
+
+    def talk(self):
+        if self.result is None:
+            raise _timeout()
+        self.reply(self.result)
+        self.ready_at = None
+
+    def wait_on_event(self, event_type, timeout):
+        """Block until the measurement is done (service request)"""
+        deadline = time() + timeout / 1e3
+        while not self.data_ready():
+            if time() > deadline:
+                raise _timeout()
+            _sleep(.001)
+
+
+class GwinstekLCR8110GSimulator(Session):
+    """GW Instek LCR-8110G over its serial port
+
+    bias() returns the DC bias applied to the device, usually from the HP4277A
+    simulator."""
+
+    TERMINATION = '\n'
+    measure_time = [.005, .02, .08, .3]
+    measure_noise = [3e-3, 1e-3, 3e-4, 1e-4]
+
+    def __init__(self, reading=mos_capacitor, bias=None, **kwargs):
+        super().__init__(**kwargs)
+        self.reading = reading
+        self.bias = bias or (lambda: 0.)
+        self.settings = {'freq': 1e6, 'equ-cct': 0, 'lev': 1.,
+                         'func:major': 0, 'func:minor': 2, 'speed': 1}
+
+    def command(self, command):
+        command = command.lower()
+        if command == '*idn?':
+            self.reply('GWInstek,LCR-8110G,0,1.00')
+            return
+        if command == ':meas:trig':
+            self.measure()
+            return
+        key, _, value = command[len(':meas:'):].partition(' ')
+        if key.endswith('?'):
+            value = self.settings[key[:-1]]
+            if isinstance(value, float):
+                self.reply('{:e}'.format(value))
+            else:
+                self.reply('{:d}'.format(value))
+        elif key == 'equ-cct':
+            self.settings[key] = ['par', 'ser'].index(value)
+        elif key in self.settings:
+            self.settings[key] = type(self.settings[key])(
+                value if key in ('freq', 'lev') else int(value))
+
+    def measure(self):
+        speed = self.settings['speed']
+        _sleep(self.measure_time[speed])
+        c, g = self.reading(self.bias(), self.settings['freq'])
+        noise = self.measure_noise[speed]
+        c *= 1 + random.gauss(0, noise)
+        g *= 1 + random.gauss(0, noise)
+        w = 2 * math.pi * self.settings['freq']
+        # C and R in the parallel equivalent circuit
+        self.reply('{:e},{:e}'.format(c, 1 / g if self.settings['equ-cct'] == 0
+                                      else g / (g * g + w * w * c * c)))
+
+
+def _engineering(seconds):
+    """Format like the HP8112A front panel: 3 digits plus NS, US, MS or S"""
+    for unit, factor in (('NS', 1e-9), ('US', 1e-6), ('MS', 1e-3)):
+        if abs(seconds) < 1000 * factor:
+            break
+    else:
+        unit, factor = 'S', 1.
+    value = seconds / factor
+    decimals = max(0, 2 - int(math.floor(math.log10(abs(value))))) \
+        if value else 2
+    return '{:.{}f} {}'.format(value, decimals, unit)
+
+_units = dict(ns=1e-9, us=1e-6, ms=1e-3, s=1., v=1., mv=1e-3)
+
+class HP8112ASimulator(Session):
+    """HP 8112A pulse generator
+
+    Pulses are reported to the listeners (usually a scope simulator) as
+    lists of (time, level) edges."""
+
+    TERMINATION = '\r\n'
+    times = ['PER', 'DEL', 'DBL', 'WID', 'LEE', 'TRE']
+    levels = ['HIL', 'LOL']
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.settings = dict(M='1', CT='0', T='1', W='2', SM='0', L='0',
+                             C='0', D='1')
+        self.values = dict(PER=1e-3, DBL=200e-6, DEL=65e-9, WID=100e-6,
+                           LEE=10e-9, TRE=10e-9, HIL=1., LOL=0.)
+        self.listeners = []
+        self.output_high = False
+
+    def cst(self):
+        parts = ['{}{}'.format(key, self.settings[key]) for key in
+                 ['M', 'CT', 'T', 'W', 'SM', 'L', 'C', 'D']]
+        parts.append('BUR 0001 #')
+        parts += ['{} {}'.format(key, _engineering(self.values[key]))
+                  for key in ['PER', 'DBL', 'DEL']]
+        parts.append('DTY 50%')
+        parts += ['{} {}'.format(key, _engineering(self.values[key]))
+                  for key in ['WID', 'LEE', 'TRE']]
+        parts += ['{} {:+.2f} V'.format(key, self.values[key])
+                  for key in self.levels]
+        return ' ' + ','.join(parts) + ','
+
+    def format_value(self, key):
+        if key in self.levels:
+            return '{} {:+.2f} V'.format(key, self.values[key])
+        return '{} {}'.format(key, _engineering(self.values[key]))
+
+    def command(self, command):
+        if command == 'CST':
+            self.reply(self.cst())
+            return
+        match = re.match(r'(I?)([A-Z]+)\s*(.*)$', command)
+        query, key, argument = match.groups()
+        if query and (key in self.values or key in self.settings):
+            if key in self.values:
+                self.reply(self.format_value(key))
+            else:
+                self.reply(key + self.settings[key])
+        elif key in self.values:
+            number, _, unit = argument.partition(' ')
+            self.values[key] = float(number) * _units.get(unit.lower(), 1.)
+        elif key in self.settings:
+            old = self.settings[key]
+            self.settings[key] = argument
+            if key == 'T' and self.settings['M'] == '4' and old != argument:
+                self.external_width(argument)
+
+    @property
+    def enabled(self):
+        return self.settings['D'] == '0'
+
+    def edge(self, rising):
+        return [(0., self.values['LOL' if rising else 'HIL']),
+                (self.values['LEE' if rising else 'TRE'],
+                 self.values['HIL' if rising else 'LOL'])]
+
+    def emit(self, edges):
+        if self.settings['C'] == '1':
+            high, low = self.values['HIL'], self.values['LOL']
+            edges = [(tt, high + low - level) for tt, level in edges]
+        for listener in self.listeners:
+            listener(edges)
+
+    def external_width(self, control):
+        # With LEVEL at its minimum the trigger control switches the output
+        rising = control == '1'
+        if self.enabled and rising != self.output_high:
+            self.output_high = rising
+            self.emit(self.edge(rising))
+
+    def trigger(self):
+        if not self.enabled or self.settings['M'] != '2':
+            return
+        lee, tre = self.values['LEE'], self.values['TRE']
+        width = self.values['WID']
+        start = self.values['DEL']
+        # Width is measured at half amplitude
+        self.emit([(start, self.values['LOL']),
+                   (start + lee, self.values['HIL']),
+                   (start + .5 * (lee - tre) + width, self.values['HIL']),
+                   (start + .5 * (lee + tre) + width, self.values['LOL'])])
+
+
+class GwinstekGDS2062Simulator(Session):
+    """GW Instek GDS-2062 oscilloscope in single shot mode
+
+    Listens to a generator simulator: when armed, the first edge matching the
+    trigger slope is captured. response(time, edges) returns the channel 2
+    waveform for the generator waveform in channel 1."""
+
+    TERMINATION = '\n'
+    words = ['acquire', 'average', 'bwlimit', 'channel', 'couple', 'coupling',
+             'delay', 'display', 'invert', 'length', 'level', 'memory',
+             'mode', 'offset', 'recall', 'run', 'save', 'scale', 'setup',
+             'slope', 'source', 'state', 'stop', 'timebase', 'trigger',
+             'type']
+    record_lengths = [500, 25000]
+    xdivisions = 20
+    # Time from :run until the pretrigger buffer is filled
+    arm_time = .02
+
+    def __init__(self, response=None, tau=1e-4, **kwargs):
+        super().__init__(**kwargs)
+        self.response = response
+        self.tau = tau
+        self.settings = {
+            'acquire:length': 0, 'acquire:average': 1, 'acquire:mode': 0,
+            'trigger:level': 0., 'trigger:mode': 1, 'trigger:couple': 1,
+            'trigger:slope': 0, 'trigger:source': 0, 'trigger:type': 0,
+            'timebase:delay': 0., 'timebase:scale': 1e-3}
+        for channel in (1, 2):
+            self.settings.update({
+                'channel{}:bwlimit'.format(channel): 0,
+                'channel{}:coupling'.format(channel): 1,
+                'channel{}:display'.format(channel): 1,
+                'channel{}:invert'.format(channel): 0,
+                'channel{}:offset'.format(channel): 0.,
+                'channel{}:scale'.format(channel): 1.})
+        self.armed_at = None
+        self.captured = None
+
+    def listen(self, generator):
+        generator.listeners.append(self.edges)
+
+    def normalize(self, path):
+        nodes = []
+        for node in path.lower().strip(':').split(':'):
+            match = re.match(r'([a-z*]+)(\d*)$', node)
+            word, number = match.groups()
+            candidates = [ww for ww in self.words if ww == word] or \
+                [ww for ww in self.words if ww.startswith(word)]
+            nodes.append((candidates[0] if candidates else word) + number)
+        return ':'.join(nodes)
+
+    def command(self, command):
+        path, _, argument = command.partition(' ')
+        query = path.endswith('?')
+        path = self.normalize(path.rstrip('?'))
+        if path == '*idn':
+            self.reply('GW,GDS-2062,0,V1.00')
+        elif path == 'run':
+            self.captured = None
+            self.armed_at = time()
+        elif path == 'stop':
+            self.armed_at = None
+        elif path == 'acquire:state':
+            self.reply('{:d}'.format(self.captured is not None))
+        elif re.match(r'acquire\d:memory', path):
+            self.reply(self.block(int(path[len('acquire')])))
+        elif path in self.settings:
+            if query:
+                value = self.settings[path]
+                self.reply('{:E}'.format(value) if isinstance(value, float)
+                           else '{:d}'.format(value))
+            else:
+                self.settings[path] = type(self.settings[path])(
+                    float(argument))
+
+    @property
+    def points(self):
+        return self.record_lengths[self.settings['acquire:length']]
+
+    @property
+    def dt(self):
+        return self.xdivisions * self.settings['timebase:scale'] / self.points
+
+    def edges(self, edges):
+        if self.armed_at is None or self.captured is not None:
+            return
+        if time() - self.armed_at < self.arm_time:
+            # Pretrigger buffer not filled yet
+            return
+        rising = self.settings['trigger:slope'] == 0
+        for (t0, v0), (t1, v1) in zip(edges[:-1], edges[1:]):
+            if v1 != v0 and (v1 > v0) == rising:
+                break
+        else:
+            return
+        # Times relative to the triggering edge
+        self.captured = [(tt - t0, level) for tt, level in edges]
+        self.armed_at = None
+
+    def waveform(self, channel):
+        # Trigger at the centre of the record, shifted by the delay
+        tt = (np.arange(self.points) - self.points / 2) * self.dt + \
+            self.settings['timebase:delay']
+        times, levels = zip(*self.captured)
+        signal = np.interp(tt, times, levels)
+        if channel == 2:
+            if self.response is not None:
+                signal = self.response(tt, self.captured)
+            else:
+                # Displacement current of a capacitor through a resistor
+                signal = np.zeros_like(tt)
+                for (t0, v0), (t1, v1) in zip(self.captured[:-1],
+                                              self.captured[1:]):
+                    if t1 > t0:
+                        slope = (v1 - v0) / (t1 - t0)
+                        for start, sign in ((t0, 1), (t1, -1)):
+                            after = np.clip(tt - start, 0, None)
+                            signal += sign * slope * self.tau * (
+                                1 - np.exp(-after / self.tau))
+            if self.settings['channel2:invert']:
+                signal = -signal
+        signal = signal + self.settings['channel{}:offset'.format(channel)]
+        scale = self.settings['channel{}:scale'.format(channel)]
+        return np.clip(np.round(signal / scale * 0x100 / 10.), -0x8000,
+                       0x7fff).astype('>i2')
+
+    def block(self, channel):
+        if self.captured is None:
+            samples = np.zeros(self.points, dtype='>i2')
+        else:
+            samples = self.waveform(channel)
+        data = struct.pack('>fB3x', self.dt, channel) + samples.tobytes()
+        length = str(len(data))
+        return '#{}{}'.format(len(length), length).encode('ascii') + data
+
+
+def iv_bench(dut=diode, **kwargs):
+    """Current source, electrometer and matrix wired to a two terminal DUT
+
+    Returns sessions by resource name as used by vi.py and vi_gui.py"""
+    source = Keithley220Simulator(**kwargs)
+    electrometer = Keithley617Simulator(
+        reading=lambda function: dut(source.current), **kwargs)
+    return {'GPIB0::12::INSTR': source,
+            'GPIB0::28::INSTR': electrometer,
+            'GPIB0::29::INSTR': Keithley705Simulator(**kwargs)}
+
+
+def cv_bench(dut=mos_capacitor, **kwargs):
+    """Bias source/LCR meter, second LCR meter and matrix for cv.py, cf.py
+    and cv_gui.py"""
+    hp = HP4277ASimulator(reading=dut, **kwargs)
+    return {'GPIB0::17::INSTR': hp,
+            0: GwinstekLCR8110GSimulator(reading=dut, bias=lambda: hp.bias,
+                                         **kwargs),
+            'GPIB0::29::INSTR': Keithley705Simulator(**kwargs)}
+
+
+def pulse_bench(**kwargs):
+    """Pulse generator driving the scope as used by cv_pulsada.py"""
+    generator = HP8112ASimulator(**kwargs)
+    scope = GwinstekGDS2062Simulator(**kwargs)
+    scope.listen(generator)
+    return {'GPIB0::11::INSTR': generator, 'ASRL5::INSTR': scope}
+
+
+class _ResourceManager(object):
+    def __init__(self, session):
+        self.session = session
+
+    def open_resource(self, resource_name, **kwargs):
+        return self.session
+
+
+def attach(driver, session):
+    """Make driver talk to session. Call before initialize()"""
+    if isinstance(driver, SerialDriver):
+        driver.serial = session
+    else:
+        driver.resource_manager = _ResourceManager(session)
+        driver.resource = session
+    driver.session = session
+    return driver
+
+
+_original_init = {}
+
+def install(sessions):
+    """Attach every driver created from now on to its simulated session
+
+    sessions maps VISA resource names and serial ports to sessions."""
+    def patch(cls, key):
+        original = _original_init.setdefault(cls, cls.__init__)
+        def __init__(self, *args, **kwargs):
+            original(self, *args, **kwargs)
+            name = key(self, args, kwargs)
+            if name in sessions:
+                attach(self, sessions[name])
+        cls.__init__ = __init__
+    patch(MessageVisaDriver, lambda self, args, kwargs: getattr(
+        self, 'resource_name', args[0] if args else None))
+    patch(SerialDriver, lambda self, args, kwargs: kwargs.get(
+        'port', args[0] if args else 1))
+
+
+def uninstall():
+    for cls, original in _original_init.items():
+        cls.__init__ = original
+    _original_init.clear()
@@ -0,0 +1,36 @@
+"""Keithley 617 status decoding against the simulated electrometer
+
+    python -m pytest test_keithley617.py
+"""
+from keithley617 import Keithley617
+from simulated import Keithley617Simulator, attach
+
+
+def electrometer(**settings):
+    session = Keithley617Simulator()
+    inst = attach(Keithley617('GPIB0::28::INSTR'), session)
+    inst.initialize()
+    session.settings.update(settings)
+    return inst
+
+
+def test_status_fixed_range():
+    inst = electrometer(F=1, R=3, C=0)
+    status = inst.status
+    assert status[3:7] == '1030'
+    assert inst.recall('range') == 3
+    assert inst.recall('function') == 'amps'
+    assert inst.recall('zero_check') is False
+
+
+def test_status_unknown_range_code():
+    inst = electrometer(R=12, C=1)
+    inst.status
+    assert inst.recall('zero_check') is True
+    assert inst.recall('function') == 'volts'
+
+
+def test_refresh_list_keeps_order():
+    inst = electrometer(F=0, R=2)
+    rng, function = inst.refresh(['range', 'function'])
+    assert (rng, function) == (2, 'volts')
@@ -40,3 +40,43 @@ def arange(initial, final, increment):
         return Q_(ret, units)
     else:
         return ret
+
+def set_raw_cache(driver, name, raw, key=None):
+    """Fill the cache of Feat name (or of one key of a DictFeat) with the value
+    its getter would have returned raw"""
+    feat = driver._lantz_features[name]
+    if key is None:
+        feat.set_cache(driver, feat.post_get(raw, driver))
+    else:
+        feat.set_cache(driver, feat.post_get(raw, driver, key), key)
+
+def refresh_snapshots(driver, keys, refresh):
+    """Refresh Feats, reading each group in driver.snapshots with one query
+
+    driver.snapshots maps the name of a Feat whose getter fills the caches of
+    other Feats (usually a status string) to the names of those Feats. refresh
+    is the refresh method of the driver's base class."""
+    if isinstance(keys, dict):
+        return refresh(keys)
+    single = isinstance(keys, str)
+    if keys is None:
+        names = list(driver._lantz_features)
+    elif single:
+        names = [keys]
+    else:
+        names = list(keys)
+    remaining = list(names)
+    for query, dependents in driver.snapshots.items():
+        if any(name == query or name in dependents for name in names):
+            refresh(query)
+            remaining = [name for name in remaining
+                         if name != query and name not in dependents]
+    if remaining:
+        refresh(remaining)
+    values = {name: driver.recall(name) for name in names}
+    if single:
+        return values[keys]
+    if keys is None:
+        return values
+    # Like Driver.refresh, a tuple in the order asked for
+    return tuple(values[name] for name in names)
@@ -1,7 +1,7 @@
 import logging
 import argparse
 import numpy as np
-from time import sleep
+from time import sleep, time
 from datetime import datetime
 
 from lantz import initialize_many, finalize_many, LOGGER, Q_
@@ -43,6 +43,10 @@ parser.add_argument('--estres', type=Q_, default=Q_(0, 's'),
         help='Tiempo de estrés en última corriente')
 parser.add_argument('--muestreoestres', type=Q_, default=Q_(1, 's'),
         help='Tiempo entre mediciones de tensión durante estrés')
+parser.add_argument('--secuencia', choices=['bus', 'temporizador'],
+        help='Cargar las corrientes en la memoria de la fuente y avanzar con '
+        'triggers de bus o con el temporizador de la fuente (cada punto dura '
+        '--delay y se mide una sola vez)')
 args = parser.parse_args()
 
 i_src = Keithley220('GPIB0::12::INSTR')
@@ -84,9 +88,31 @@ salida.write('# Matriz : ' + matriz.status + '\n')
 salida.write('# Estrés : {:f~}\n'.format(args.estres))
 salida.write('# Corriente[A]\tTension[V]\tTiempo[s]\n')
 try:
-    for channel in [(1, 1), (1, 4), (4, 2), (4, 3), (4, 4), (2, 1)]:
-        matriz.close(channel)
-    i_src.current = corrientes[0]
+    matriz.apply_routing('vi')
+    bloque = i_src.program_locations
+    if args.secuencia == 'temporizador':
+        # El programa continuo da la vuelta a la posición 1 al terminar: dejo
+        # al menos una posición de más con la última corriente del bloque
+        bloque -= 1
+    permanencia = args.delay.to('s').magnitude
+
+    def cargar(ii):
+        """Carga en la memoria el bloque de corrientes que empieza en ii
+
+        Al recorrer las posiciones la fuente entrega cada corriente, hay que
+        hacerlo con la salida apagada"""
+        if args.secuencia == 'bus':
+            i_src.load_program(corrientes[ii:ii + bloque])
+            i_src.program = 'step'
+        else:
+            i_src.load_program(corrientes[ii:ii + bloque], args.delay,
+                               fill=True)
+            i_src.program = 'continuous'
+
+    if args.secuencia:
+        cargar(0)
+    else:
+        i_src.current = corrientes[0]
     i_src.output = True
     # Abro el corto a la salida de la fuente
     matriz.open((1, 1))
@@ -94,17 +120,49 @@ try:
     for ii, corriente in enumerate(corrientes):
         print('{}/{}: {:.1e~}'.format(ii+1, len(corrientes), corriente),
                 end='', flush=True)
-        i_src.current = corriente
-        if args.no_estabilizar:
+        if not args.secuencia:
+            i_src.current = corriente
+        elif ii % bloque == 0:
+            if ii:
+                # Cargo el siguiente bloque de corrientes en la memoria
+                i_src.output = False
+                cargar(ii)
+                i_src.output = True
+            if args.secuencia == 'temporizador':
+                # El trigger arranca el programa
+                i_src.step()
+                inicio = time()
+        elif args.secuencia == 'bus':
+            i_src.step()
+        if args.secuencia == 'temporizador':
+            # Mido al final del tiempo de permanencia de cada punto
+            sleep(max(0, inicio + (ii % bloque + .9) * permanencia - time()))
+            tension = electrometro.voltage
+            print(' {:.1e~}'.format(tension))
+            if ii % bloque == bloque - 1 or ii == len(corrientes) - 1:
+                # Detengo el programa en el último punto cargado, antes de
+                # que avance a posiciones que no son de este bloque
+                i_src.program = 'single'
+                i_src.current = corriente
+        elif args.no_estabilizar:
             sleep(args.delay.to('s').magnitude)
             tension = electrometro.voltage
             print(' {:.1e~}'.format(tension))
         else:
-            tension, mediciones = electrometro.stable_voltage(.001)
-            print(' {:.1e~} ({} mediciones)'.format(tension, mediciones))
+            tension, lecturas = electrometro.stable_voltage(.001)
+            print(' {:.1e~} ({} lecturas)'.format(tension, lecturas))
+            if not electrometro.last_convergence.converged:
+                print('No se estabilizó')
+                # Comentario antes del punto, lo saltea np.loadtxt
+                salida.write('# Sin estabilizar tras {} lecturas\n'.format(
+                    lecturas))
         salida.write('{}\t{}\t{}\n'.format(corriente.to('A').magnitude,
             tension.to('V').magnitude, datetime.now().timestamp()))
         if ii == len(corrientes) - 1:
+            if args.secuencia:
+                # Salgo del programa para mantener la última corriente
+                i_src.program = 'single'
+                i_src.current = corriente
             print('Estresando {:f}'.format(args.estres))
             while args.estres > Q_(0, 's'):
                 if args.estres >= args.muestreoestres:
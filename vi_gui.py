@@ -97,8 +97,7 @@ class VI_GUI(base):
         yield from self.matriz.matrix_mode_async()
         signo = [1, -1][self.ui.invertir_polaridad.isChecked()]
         # Pongo la fuente en corto
-        for channel in [(1, 1), (1, 4), (4, 2), (4, 3), (4, 4), (2, 1)]:
-            yield from self.matriz.close_async(channel)
+        yield from self.matriz.apply_routing_async('vi')
         yield from self.i_src.update_async(
             current=self.corrientes[0] * signo,
             voltage_limit = Q_(self.ui.limite_tension.text()).to('V'),
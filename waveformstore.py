@@ -0,0 +1,164 @@
+"""Append-only binary file with the captures of a pulsed C-V sweep
+
+Each record is one captured edge: a JSON header (pulse number, edge, width,
+instrument settings and, per channel, scale, offset, dt, sample count and
+type) followed by the raw samples of its channels, optionally compressed
+with zlib. Samples are int16 as captured, or float32 for averages.
+Uncompressed samples are read through a memory map.
+
+    with WaveformStore('barrido.cvp', 'a') as store:
+        store.append(waveforms, pulse=ii, edge=jj, width=1e-3)
+    for record in WaveformStore('barrido.cvp'):
+        print(record.header['width'], record.waveforms[1].volts)
+
+Exportar a archivos de texto como los de las versiones anteriores:
+
+    python waveformstore.py barrido.cvp carpeta
+"""
+import json
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from gwinstekgds2062 import Waveform
+
+MAGIC = b'CVPULSO1\n'
+# Length of the JSON header that starts each record
+LENGTH = struct.Struct('<I')
+SAMPLE = np.dtype('<i2')
+AVERAGE = np.dtype('<f4')
+
+
+class Record(namedtuple('Record', 'header waveforms')):
+    """header is the dictionary given to append, waveforms maps channel
+    numbers to Waveforms"""
+
+
+class WaveformStore(object):
+    """One sweep file, opened for reading ('r') or appending ('a')"""
+
+    def __init__(self, filename, mode='r', compress=False):
+        if mode not in ('r', 'a'):
+            raise ValueError('Invalid mode: {}'.format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.compress = compress
+        self._map = None
+        if mode == 'a':
+            new = not os.path.exists(filename) or \
+                os.path.getsize(filename) == 0
+            self._fd = open(filename, 'ab')
+            if new:
+                self._fd.write(MAGIC)
+            self._index = None
+        else:
+            self._fd = open(filename, 'rb')
+            if self._fd.read(len(MAGIC)) != MAGIC:
+                raise RuntimeError('Not a waveform store: {}'.format(
+                    filename))
+            self._index = self.scan()
+
+    def append(self, waveforms, **header):
+        """Write a record with the waveforms dictionary (channel: Waveform)
+        and header, which must be JSON serializable"""
+        channels = []
+        payload = []
+        for channel in sorted(waveforms):
+            waveform = waveforms[channel]
+            dtype = SAMPLE if np.issubdtype(waveform.raw.dtype, np.integer) \
+                else AVERAGE
+            channels.append(dict(channel=channel, samples=len(waveform),
+                                 scale=waveform.scale, offset=waveform.offset,
+                                 dt=waveform.dt, t0=waveform.t0,
+                                 dtype=dtype.str))
+            payload.append(np.asarray(waveform.raw, dtype=dtype).tobytes())
+        payload = b''.join(payload)
+        if self.compress:
+            payload = zlib.compress(payload)
+        header = dict(header, channels=channels, size=len(payload),
+                      compression='zlib' if self.compress else None)
+        encoded = json.dumps(header).encode('utf-8')
+        self._fd.write(LENGTH.pack(len(encoded)) + encoded + payload)
+        self._fd.flush()
+
+    def scan(self):
+        """Header and payload offset of every record"""
+        index = []
+        self._fd.seek(len(MAGIC))
+        while True:
+            length = self._fd.read(LENGTH.size)
+            if len(length) < LENGTH.size:
+                return index
+            header = json.loads(self._fd.read(
+                LENGTH.unpack(length)[0]).decode('utf-8'))
+            index.append((header, self._fd.tell()))
+            self._fd.seek(header['size'], os.SEEK_CUR)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, index):
+        header, offset = self._index[index]
+        if header['compression'] == 'zlib':
+            self._fd.seek(offset)
+            payload = np.frombuffer(zlib.decompress(
+                self._fd.read(header['size'])), dtype=np.uint8)
+        else:
+            if self._map is None:
+                self._map = np.memmap(self.filename, dtype=np.uint8,
+                                      mode='r')
+            payload = self._map[offset:offset + header['size']]
+        waveforms = dict()
+        start = 0
+        for channel in header['channels']:
+            dtype = np.dtype(channel.get('dtype', SAMPLE))
+            end = start + channel['samples'] * dtype.itemsize
+            raw = payload[start:end].view(dtype)
+            start = end
+            waveforms[channel['channel']] = Waveform(
+                raw, channel['scale'], channel['dt'], channel['offset'],
+                channel['t0'])
+        return Record(header, waveforms)
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def close(self):
+        self._map = None
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_text(filename, dirname):
+    """Write each record as a text file named like the sweep did before"""
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    with WaveformStore(filename) as store:
+        for header, waveforms in store:
+            prefijo = os.path.join(dirname, '{:03d}_{:.2e} s_{:d}'.format(
+                header['pulse'], header['width'], header['edge']))
+            if header.get('stat', 'media') != 'media':
+                prefijo += '_' + header['stat']
+            columnas = [waveforms[1].time] + [waveforms[channel].volts
+                                              for channel in sorted(waveforms)]
+            np.savetxt(prefijo + '.txt', np.column_stack(columnas),
+                       header=header.get('comments', ''))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Exporta un barrido de CV '
+                                     'pulsada a archivos de texto')
+    parser.add_argument('archivo', help='Archivo del barrido')
+    parser.add_argument('carpeta', help='Carpeta para los archivos de texto')
+    args = parser.parse_args()
+    export_text(args.archivo, args.carpeta)